@@ -3,8 +3,12 @@ import math
 import utm
 import geopandas as gpd
 import logging
+import warnings
 import numpy as np
+import shapely
 import folium
+from pyproj import CRS
+from scipy.spatial import cKDTree
 
 
 def add_runtime(st):
@@ -245,6 +249,69 @@ def add_free_flow(speeds, data_complete):
     return data_complete
 
 
+# Columns of Feed.segments that describe each segment of the speed tables
+SEGMENT_COLUMNS = [
+    "route_name",
+    "direction_id",
+    "segment_id",
+    "route_id",
+    "stop_sequence",
+    "segment_name",
+    "start_stop_name",
+    "end_stop_name",
+    "start_stop_id",
+    "end_stop_id",
+    "shape_id",
+    "distance_m",
+    "geometry",
+]
+
+
+def speed_table_columns(value_columns):
+    """
+    Column order of the tables of speeds per route, segment and window
+    (avg_speeds, speed_distribution), with value_columns after the keys.
+    """
+    return (
+        ["route_id", "route_name", "direction_id", "stop_sequence", "segment_name", "window"]
+        + list(value_columns)
+        + ["start_stop_name", "end_stop_name", "segment_id", "start_stop_id", "end_stop_id"]
+        + ["shape_id", "distance_m", "geometry"]
+    )
+
+
+def aggregate_speed_distribution(speeds, index, quantiles, bins):
+    """
+    Distribution of runtimes and speeds per group in a single grouped pass.
+    Input:
+        - speeds: DataFrame with runtime_sec and speed_kmh.
+        - index: list of columns to group by.
+        - quantiles: list of floats between 0 and 1.
+        - bins: list of left-closed speed edges in km/h for the histogram.
+    Output:
+        - DataFrame with one row per group with the number of observations,
+          the quantiles of runtime_sec and speed_kmh (e.g. speed_kmh_p50)
+          and the number of observations in each speed bin (e.g. speed_kmh_10_20).
+          Histogram counts of different inputs can be added up.
+    """
+    grouped = speeds.groupby(index)
+
+    dist = grouped[["runtime_sec", "speed_kmh"]].quantile(quantiles).unstack()
+    dist.columns = [f"{col}_p{q * 100:g}" for col, q in dist.columns]
+    dist.insert(0, "n_obs", grouped.size())
+
+    labels = [f"speed_kmh_{low:g}_{high:g}" for low, high in zip(bins[:-1], bins[1:])]
+    speed_bin = pd.cut(speeds.speed_kmh, bins=bins, right=False, labels=labels)
+    hist = (
+        speeds.groupby(index + [speed_bin], observed=True)
+        .size()
+        .unstack(fill_value=0)
+        .reindex(columns=labels, fill_value=0)
+    )
+
+    return dist.join(hist).fillna({label: 0 for label in labels}).reset_index()
+
+
 def add_all_lines(line_frequencies, segments_gdf, labels, cutoffs):
 
     logging.info("adding data for all lines.")
@@ -272,10 +339,8 @@ def add_all_lines(line_frequencies, segments_gdf, labels, cutoffs):
     data_all_lines["direction_id"] = "NA"
 
     # Add frequency for all lines
-    start_time = data_all_lines.window.apply(lambda x: cutoffs[labels.index(x)])
-    end_time = data_all_lines.window.apply(lambda x: cutoffs[labels.index(x) + 1])
-
-    data_all_lines["min_per_trip"] = ((end_time - start_time) * 60 / data_all_lines.ntrips).astype(int)
+    minutes = pd.Series(np.diff(cutoffs) * 60, index=labels)
+    data_all_lines["min_per_trip"] = (data_all_lines.window.map(minutes) / data_all_lines.ntrips).astype(int)
 
     # Append data for all lines to the input df
     data_complete = pd.concat([line_frequencies, data_all_lines]).reset_index(drop=True)
@@ -343,27 +408,202 @@ def label_creation(cutoffs):
 
 
 def window_creation(stop_times, cutoffs):
-    "Adds the time time window and labels to stop_times"
+    """
+    Returns the rows of stop_times that fall in a time window, with the
+    window label added. The input DataFrame is not modified.
+    """
+    codes = window_codes(stop_times.departure_time.values, cutoffs)
+    stop_times = stop_times.loc[codes >= 0].copy()
 
     # If the cutoffs are withing 0 and 24 hours, let's make sure
     # the times of the GTFS fit this time period
     if max(cutoffs) <= 24:
-        stop_times["departure_time"] = fix_departure_time(stop_times.departure_time.values)
-        stop_times["arrival_time"] = fix_departure_time(stop_times.arrival_time.values)
+        stop_times["departure_time"] = fix_departure_time(stop_times.departure_time.values.copy())
+        stop_times["arrival_time"] = fix_departure_time(stop_times.arrival_time.values.copy())
 
-    # Create the labels for the cutoffs
+    # Put each trip in the right window
     labels = label_creation(cutoffs)
+    stop_times["window"] = np.asarray(labels, dtype=object)[codes[codes >= 0]]
 
-    # Get departure time as hour and a fraction
-    departure_time = stop_times.departure_time / 3600
+    return stop_times
 
-    # Put each trip in the right window
-    stop_times["window"] = pd.cut(departure_time, bins=cutoffs, right=False, labels=labels)
-    stop_times = stop_times.loc[~stop_times.window.isnull()]
 
-    stop_times["window"] = stop_times.window.astype(str)
+def window_codes(times, cutoffs):
+    """
+    Puts each time in its time window without modifying the input.
+    Input:
+        - times: np.array with seconds since midnight.
+        - cutoffs: list of floats or int.
+    Output:
+        - np.array of integers with the position of the window of each
+          time, -1 for the times that fall outside every window.
+    """
+    hours = np.asarray(times, dtype=float) / 3600
 
-    return stop_times
+    # If the cutoffs are withing 0 and 24 hours, times after midnight
+    # go to the beginning of the day, as in fix_departure_time
+    if max(cutoffs) <= 24:
+        hours = np.where(hours >= 24, hours - 24, hours)
+
+    codes = np.searchsorted(cutoffs, hours, side="right") - 1
+    codes[~((hours >= cutoffs[0]) & (hours < cutoffs[-1]))] = -1
+
+    return codes
+
+
+def window_frequency(counts, index_, labels, cutoffs):
+    """
+    Aggregates the trip counts of a window index into frequencies.
+    Input:
+        - counts: DataFrame with the ntrips of each window code, as in Feed.window_index.
+        - index_: list of columns to aggregate by, besides direction_id and window.
+    Output:
+        - DataFrame with ntrips and min_per_trip by index_, direction_id and window.
+    """
+    index_list = index_ + ["direction_id", "window"]
+    minutes = pd.Series(np.diff(cutoffs) * 60, index=labels)
+
+    counts = counts.assign(window=np.asarray(labels, dtype=object)[counts.window_code.values])
+    trips_agg = counts.groupby(index_list).ntrips.sum().reset_index()
+    trips_agg["min_per_trip"] = (trips_agg.window.map(minutes).values / trips_agg.ntrips).astype(int)
+
+    return trips_agg
+
+
+def sorted_departures(keys, times):
+    """
+    Groups departure times by key in a single sorted array.
+    Input:
+        - keys: DataFrame with the key columns of each departure.
+        - times: np.array with the departure times in seconds.
+    Output:
+        - key_values: DataFrame with one row per key, sorted.
+        - offsets: np.array with the first departure of each key,
+          followed by the total number of departures.
+        - sorted_times: np.array with the departure times sorted by key and time.
+    Departures with a null key or time are left out.
+    """
+    times = np.asarray(times, dtype=float)
+    grouped = keys.groupby(list(keys.columns), sort=True)
+    key_codes = grouped.ngroup().values
+    key_values = grouped.size().index.to_frame(index=False)
+
+    valid = (key_codes >= 0) & ~np.isnan(times)
+    order = np.lexsort((times[valid], key_codes[valid]))
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(key_codes[valid], minlength=len(key_values)))])
+
+    return key_values, offsets, times[valid][order]
+
+
+def count_departures(offsets, sorted_times, starts, width):
+    """
+    Counts the departures of every key in each interval [start, start + width).
+    Input:
+        - offsets, sorted_times: departures as returned by sorted_departures.
+        - starts: np.array with the start of each interval in seconds.
+        - width: length of the intervals in seconds.
+    Output:
+        - (n_keys, n_starts) np.array of integers.
+    """
+    n_keys = len(offsets) - 1
+    starts = np.asarray(starts, dtype=float)
+    if n_keys == 0 or len(starts) == 0:
+        return np.zeros((n_keys, len(starts)), dtype=int)
+
+    # Shift each key onto its own band of time so a single
+    # searchsorted answers the queries of every key
+    low = min(sorted_times.min(initial=np.inf), starts.min())
+    span = max(sorted_times.max(initial=-np.inf), starts.max() + width) - low + 1
+    band = np.arange(n_keys) * span
+    banded_times = sorted_times - low + np.repeat(band, np.diff(offsets))
+
+    queries = (starts - low)[None, :] + band[:, None]
+    first = np.searchsorted(banded_times, queries, side="left")
+    last = np.searchsorted(banded_times, queries + width, side="left")
+
+    return last - first
+
+
+def departure_board(stop_codes, times, n_stops):
+    """
+    Sorts departures by stop and time so the departures of any stop
+    and time range are found with binary search.
+    Input:
+        - stop_codes: np.array with the stop position of each departure.
+        - times: np.array with the departure times in seconds.
+        - n_stops: number of stops.
+    Output: dictionary with
+        - offsets: np.array with the first departure of each stop,
+          followed by the total number of departures.
+        - order: np.array with the departure rows sorted by stop and time.
+        - times: np.array with the sorted departure times.
+        - banded_times: sorted times shifted onto one band per stop.
+        - low, span: start and length of the bands.
+    Departures without a time are left out.
+    """
+    times = np.asarray(times, dtype=float)
+    rows = np.nonzero(~np.isnan(times))[0]
+    order = rows[np.lexsort((times[rows], stop_codes[rows]))]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(stop_codes[rows], minlength=n_stops))])
+
+    sorted_times = times[order]
+    low = sorted_times.min(initial=0)
+    span = sorted_times.max(initial=0) - low + 2
+
+    return {
+        "offsets": offsets,
+        "order": order,
+        "times": sorted_times,
+        "banded_times": sorted_times - low + np.repeat(np.arange(n_stops) * span, np.diff(offsets)),
+        "low": low,
+        "span": span,
+    }
+
+
+def board_search(board, stop_codes, times):
+    """
+    Position in a departure board of the first departure of each stop at or after each time.
+    Input:
+        - board: dictionary returned by departure_board.
+        - stop_codes: np.array with the stop position of each query.
+        - times: np.array with the time of each query in seconds.
+    Output:
+        - np.array with the positions, between the offsets of the stop and of the next one.
+    """
+    times = np.clip(np.asarray(times, dtype=float), board["low"], board["low"] + board["span"] - 1)
+
+    return np.searchsorted(board["banded_times"], times - board["low"] + stop_codes * board["span"], side="left")
+
+
+def vehicles_in_service(group_codes, starts, ends, n_groups, wrap=True):
+    """
+    Counts the vehicles in service at every minute with a sweep line over their spans.
+    A vehicle counts at minute m if start <= m * 60 < end.
+    Input:
+        - group_codes: np.array with the group (e.g. route) of each span.
+        - starts, ends: np.arrays with the start and end of each span in seconds.
+        - n_groups: number of groups.
+        - wrap: add the minutes after 24:00 to the beginning of the day.
+    Output:
+        - (n_groups, n_minutes) np.array of integers. n_minutes is 1440 with
+          wrap=True and covers the last end otherwise.
+    """
+    first = np.ceil(np.asarray(starts, dtype=float) / 60).astype(int)
+    last = np.maximum(np.ceil(np.asarray(ends, dtype=float) / 60).astype(int), first)
+
+    n_minutes = max(24 * 60, last.max(initial=0))
+    if wrap:
+        n_minutes = -(-n_minutes // (24 * 60)) * 24 * 60
+
+    events = np.zeros((n_groups, n_minutes + 1), dtype=int)
+    np.add.at(events, (group_codes, first), 1)
+    np.add.at(events, (group_codes, last), -1)
+    profile = np.cumsum(events[:, :-1], axis=1)
+
+    if wrap:
+        profile = profile.reshape(n_groups, -1, 24 * 60).sum(axis=1)
+
+    return profile
 
 
 def seconds_since_midnight(times_string):
@@ -381,34 +621,14 @@ def seconds_since_midnight(times_string):
     return seconds
 
 
-def add_frequency(
-    stop_times,
-    labels,
-    index_="stop_id",
-    col="window",
-    cutoffs=[0, 6, 9, 15, 19, 22, 24],
-):
-
-    if isinstance(index_, list):
-        index_list = index_ + ["direction_id", col]
-    elif isinstance(index_, str):
-        index_list = [index_, "direction_id", col]
-
-    # Some gtfs feeds only contain direction_id 0, use that as default
-    trips_agg = stop_times.pivot_table("trip_id", index=index_list, aggfunc="count").reset_index()
-
-    # direction_id is optional, as it is not needed to determine trip frequencies
-    # However, if direction_id is NaN, pivot_table will return an empty DataFrame.
-    # Therefore, use a sensible default if direction id is not known.
-    # Some gtfs feeds only contain direction_id 0, use that as default
-    trips_agg.rename(columns={"trip_id": "ntrips"}, inplace=True)
-
-    start_time = trips_agg.window.apply(lambda x: cutoffs[labels.index(x)])
-    end_time = trips_agg.window.apply(lambda x: cutoffs[labels.index(x) + 1])
-
-    trips_agg["min_per_trip"] = ((end_time - start_time) * 60 / trips_agg.ntrips).astype(int)
-
-    return trips_agg
+def parse_times(times):
+    """
+    Transforms a time or a list of times, in seconds since midnight
+    or "HH:MM:SS" strings, to a np.array of seconds since midnight.
+    """
+    return np.array(
+        [seconds_since_midnight(t) if isinstance(t, str) else t for t in np.atleast_1d(times)], dtype=float
+    )
 
 
 def add_route_name(data, routes):
@@ -441,20 +661,277 @@ def add_route_name(data, routes):
     return data
 
 
+def cut_segments(coords, cut_positions, shape_codes):
+    """
+    Builds the stop to stop segments of every shape in a single pass.
+    Input:
+        - coords: (n, 2) np.array with the shape vertices and projected stops
+          of all the shapes, sorted by shape and distance along the shape.
+        - cut_positions: sorted np.array with the row of each stop in coords.
+        - shape_codes: np.array of integers with the shape of each cut.
+    Output:
+        - segment_coords: (k, 2) np.array with the points of every segment,
+          one segment after the other.
+        - n_points: np.array with the number of points of each segment.
+    There is one segment for each pair of consecutive cuts within a shape.
+    """
+    same_shape = shape_codes[:-1] == shape_codes[1:]
+    start = cut_positions[:-1][same_shape]
+    end = cut_positions[1:][same_shape]
+
+    # Every segment takes the points between its two cuts, both included
+    n_points = end - start + 1
+    offsets = np.cumsum(n_points) - n_points
+    point_index = np.repeat(start - offsets, n_points) + np.arange(n_points.sum())
+
+    return coords[point_index], n_points
+
+
+def segment_shapes(vertex_coords, vertex_offsets, stop_coords, stop_offsets):
+    """
+    Cuts a group of shapes into stop to stop segments.
+    Works on plain coordinate arrays so it can run in a separate process.
+    Input:
+        - vertex_coords: (n, 2) np.array with the vertices of the shapes,
+          one shape after the other.
+        - vertex_offsets: np.array with the first vertex of each shape,
+          followed by the total number of vertices.
+        - stop_coords: (m, 2) np.array with the stops, grouped by shape.
+        - stop_offsets: np.array with the first stop of each shape,
+          followed by the total number of stops.
+    Output:
+        - cut_order: row in stop_coords of each cut, sorted by shape and
+          distance along the shape.
+        - cut_position: position of each cut among the sorted stops and
+          vertices of its shape.
+        - segment_coords, n_points: segments as returned by cut_segments.
+    """
+    n_shapes = len(vertex_offsets) - 1
+    vertex_shape = np.repeat(np.arange(n_shapes), np.diff(vertex_offsets))
+    stop_shape = np.repeat(np.arange(n_shapes), np.diff(stop_offsets))
+    lines = shapely.linestrings(vertex_coords, indices=vertex_shape)
+
+    # Project the stops onto their shape and locate the vertices along it
+    stop_distance = shapely.line_locate_point(lines[stop_shape], shapely.points(stop_coords), normalized=True)
+    stop_coords = shapely.get_coordinates(
+        shapely.line_interpolate_point(lines[stop_shape], stop_distance, normalized=True)
+    )
+    vertex_distance = shapely.line_locate_point(lines[vertex_shape], shapely.points(vertex_coords), normalized=True)
+
+    # Stops go first so that they stay ahead of the vertices they tie with
+    point_shape = np.concatenate([stop_shape, vertex_shape])
+    order = np.lexsort((np.concatenate([stop_distance, vertex_distance]), point_shape))
+    coords = np.concatenate([stop_coords, vertex_coords])[order]
+
+    is_cut = order < len(stop_shape)
+    cut_positions = np.flatnonzero(is_cut)
+    cut_shape = point_shape[order][is_cut]
+    segment_coords, n_points = cut_segments(coords, cut_positions, cut_shape)
+
+    shape_start = vertex_offsets[:-1] + stop_offsets[:-1]
+
+    return order[is_cut], cut_positions - shape_start[cut_shape], segment_coords, n_points
+
+
+def shape_content_hashes(vertex_coords, vertex_offsets, shape_stops, stop_coords, stop_offsets):
+    """
+    Hashes the content of each shape: its vertices, in order, and the stops
+    served along it with their attributes and coordinates.
+    Input:
+        - vertex_coords, vertex_offsets: vertices of the shapes, grouped by shape.
+        - shape_stops: DataFrame with the stops of the shapes, grouped by shape.
+        - stop_coords, stop_offsets: coordinates of shape_stops and the first
+          stop of each shape, followed by the total number of stops.
+    Output:
+        - np.array of uint64 with one hash per shape.
+    """
+    n_shapes = len(vertex_offsets) - 1
+    if n_shapes == 0:
+        return np.array([], dtype=np.uint64)
+
+    vertices = pd.DataFrame(
+        {
+            "x": vertex_coords[:, 0],
+            "y": vertex_coords[:, 1],
+            "position": np.arange(len(vertex_coords)) - np.repeat(vertex_offsets[:-1], np.diff(vertex_offsets)),
+        }
+    )
+    stops = shape_stops.assign(x=stop_coords[:, 0], y=stop_coords[:, 1])
+
+    # Row hashes are added up per shape, wrapping around on overflow
+    vertex_hash = np.add.reduceat(pd.util.hash_pandas_object(vertices, index=False).values, vertex_offsets[:-1])
+    stop_hash = np.add.reduceat(pd.util.hash_pandas_object(stops, index=False).values, stop_offsets[:-1])
+
+    return pd.util.hash_pandas_object(pd.DataFrame({"vertices": vertex_hash, "stops": stop_hash}), index=False).values
+
+
+def balanced_chunks(weights, n_chunks):
+    """
+    Splits the positions of weights into at most n_chunks groups
+    with a similar total weight.
+    The heaviest items are placed first, each in the lightest chunk so far.
+    Output:
+        - list of sorted np.arrays of positions.
+    """
+    n_chunks = max(1, min(n_chunks, len(weights)))
+    loads = np.zeros(n_chunks)
+    chunk_of = np.zeros(len(weights), dtype=int)
+
+    for i in np.argsort(-np.asarray(weights), kind="stable"):
+        chunk_of[i] = loads.argmin()
+        loads[chunk_of[i]] += weights[i]
+
+    return [np.flatnonzero(chunk_of == c) for c in range(n_chunks)]
+
+
+def csr_take(offsets, keys):
+    """
+    Selects the rows of some keys from data grouped by key,
+    where the rows of key k go from offsets[k] to offsets[k + 1].
+    Output:
+        - rows: np.array with the positions of the selected rows.
+        - new_offsets: offsets of the keys in the selection.
+    """
+    counts = offsets[keys + 1] - offsets[keys]
+    new_offsets = np.concatenate([[0], np.cumsum(counts)])
+    rows = np.repeat(offsets[keys] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+
+    return rows, new_offsets
+
+
+def local_metric_crs(min_lon, min_lat, max_lon, max_lat):
+    """
+    Picks a metric CRS for the area inside a bounding box.
+    Output:
+        - pyproj.CRS: the UTM zone of the area if it fits in a single zone,
+          otherwise a transverse mercator centered on the bounding box so
+          that feeds spanning several zones are not distorted.
+    """
+    center_lat = (min_lat + max_lat) / 2
+    center_lon = (min_lon + max_lon) / 2
+    zones = {utm.latlon_to_zone_number(lat, lon) for lat in (min_lat, max_lat) for lon in (min_lon, max_lon)}
+
+    if len(zones) == 1:
+        # The EPSG code is 32600+zone for positive latitudes and 32700+zone for negatives.
+        if center_lat < 0:
+            epsg_code = 32700 + zones.pop()
+        else:
+            epsg_code = 32600 + zones.pop()
+        return CRS.from_epsg(epsg_code)
+
+    logging.info("The feed spans several UTM zones, using a custom transverse mercator.")
+    return CRS.from_proj4(
+        f"+proj=tmerc +lat_0={center_lat} +lon_0={center_lon} +k=1 +x_0=0 +y_0=0 +datum=WGS84 +units=m +no_defs"
+    )
+
+
 def code(gdf):
-    gdf.index = list(range(0, len(gdf)))
-    gdf.crs = {"init": "epsg:4326"}
-    lat_referece = gdf.geometry[0].coords[0][1]
-    lon_reference = gdf.geometry[0].coords[0][0]
-
-    zone = utm.from_latlon(lat_referece, lon_reference)
-    # The EPSG code is 32600+zone for positive latitudes and 32700+zone for negatives.
-    if lat_referece < 0:
-        epsg_code = 32700 + zone[2]
-    else:
-        epsg_code = 32600 + zone[2]
+    """
+    Deprecated, use Feed.metric_crs or local_metric_crs instead.
+
+    Returns the EPSG code of the UTM zone of the first point of gdf, read as
+    lon/lat. gdf is not modified.
+    """
+    warnings.warn("code() is deprecated, use Feed.metric_crs or local_metric_crs", DeprecationWarning, stacklevel=2)
+    gdf = gdf.set_crs(4326, allow_override=True)
+    lon_reference, lat_referece = gdf.geometry.iloc[0].coords[0][:2]
+
+    return local_metric_crs(lon_reference, lat_referece, lon_reference, lat_referece).to_epsg()
+
+
+def project_coords(coords, transformer):
+    """
+    Projects a (n, 2) np.array of lon/lat coordinates with a pyproj Transformer
+    in a single call.
+    """
+    return np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+
+
+def line_lengths(coords, n_points):
+    """
+    Lengths of lines given as one buffer of projected coordinates.
+    Input:
+        - coords: (n, 2) np.array with the coordinates of the lines, one after the other.
+        - n_points: np.array with the number of coordinates of each line.
+    Output:
+        - np.array with the length of each line in the units of the coordinates.
+    """
+    step = np.hypot(*np.diff(coords, axis=0).T)
+
+    # Steps between the last point of a line and the first of the next one don't count
+    line = np.repeat(np.arange(len(n_points)), n_points)
+    step = step[line[1:] == line[:-1]]
+
+    # Each line is summed on its own, so its length doesn't depend on the other lines
+    n_steps = np.maximum(n_points - 1, 0)
+    has_steps = n_steps > 0
+    lengths = np.zeros(len(n_points))
+    if has_steps.any():
+        starts = np.concatenate([[0], np.cumsum(n_steps)[:-1]])
+        lengths[has_steps] = np.add.reduceat(step, starts[has_steps])
+
+    return lengths
+
+
+def project_geometries(geometries, transformer):
+    """
+    Projects an array of shapely geometries with a pyproj Transformer,
+    transforming the coordinates of all of them in a single call.
+    """
+    return shapely.transform(geometries, lambda coords: project_coords(coords, transformer))
+
+
+def nearest_k(tree, geometry, k):
+    """
+    Finds the k geometries of an STRtree nearest to a geometry. The search
+    starts at the distance of the nearest one and doubles until it holds k of them.
+    Input:
+        - tree: shapely STRtree.
+        - geometry: shapely geometry in the same CRS as the tree.
+        - k: number of geometries to find.
+    Output:
+        - np.array with the positions of the geometries in the tree, nearest first.
+        - np.array with their distances.
+    """
+    k = min(k, len(tree.geometries))
+    if k == 0:
+        return np.array([], dtype=int), np.array([], dtype=float)
+
+    _, distance = tree.query_nearest(geometry, return_distance=True)
+    radius = distance.min()
+    candidates = tree.query(geometry, predicate="dwithin", distance=radius)
+    while len(candidates) < k:
+        radius = radius * 2 if radius > 0 else 1
+        candidates = tree.query(geometry, predicate="dwithin", distance=radius)
+
+    distances = shapely.distance(tree.geometries[candidates], geometry)
+    order = np.lexsort((candidates, distances))[:k]
+
+    return candidates[order], distances[order]
+
+
+def stop_distance_pairs(projected_stops, radius):
+    """
+    Finds every pair of stops that are at most radius meters apart.
+    Input:
+        - projected_stops: GeoDataFrame of stops in a metric CRS.
+        - radius: float, maximum distance in meters.
+    Output:
+        - stop_index_1, stop_index_2: np.arrays with the positions of the stops
+          of each pair, sorted. Every pair appears in both directions.
+        - distances: np.array with the distance in meters of each pair.
+    """
+    coords = np.column_stack([projected_stops.geometry.x.values, projected_stops.geometry.y.values])
+    valid = np.flatnonzero(~np.isnan(coords).any(axis=1))
+
+    pairs = cKDTree(coords[valid]).query_pairs(radius, output_type="ndarray")
+    first = np.concatenate([valid[pairs[:, 0]], valid[pairs[:, 1]]])
+    second = np.concatenate([valid[pairs[:, 1]], valid[pairs[:, 0]]])
+    distances = np.hypot(*(coords[first] - coords[second]).T)
+
+    order = np.lexsort((second, first))
 
-    return epsg_code
+    return first[order], second[order], distances[order]
 
 
 def num_to_letters(num):
@@ -8,14 +8,16 @@ import requests
 import io
 import pendulum as pl
 import hashlib
-from shapely.geometry import LineString, MultiPoint
+import shapely
+from pyproj import Transformer
+from scipy.sparse import csr_matrix
+from shapely.geometry import LineString
 
 from gtfs_functions.aux_functions import *
+from gtfs_functions.routing import build_timetable, earliest_arrival, init_worker, count_reachable
 
-from itertools import permutations, chain
-from shapely import distance
-from h3 import latlng_to_cell, grid_ring
 from time import time
+from concurrent.futures import ProcessPoolExecutor
 import boto3
 import sys
 import pendulum as pl
@@ -42,7 +44,9 @@ class Feed:
         geo: bool = True,
         patterns: bool = True,
         start_date: str = None,
-        end_date: str = None
+        end_date: str = None,
+        n_jobs: int = 1,
+        previous: dict = None,
     ):
         """
         Feed class to handle GTFS data.
@@ -62,6 +66,8 @@ class Feed:
         self._patterns = patterns
         self._start_date = start_date
         self._end_date = end_date
+        self._n_jobs = n_jobs
+        self._previous = previous
         self._dates = None
         self._routes_patterns = None
         self._trips_patterns = None
@@ -76,14 +82,28 @@ class Feed:
         self._stops = None
         self._stop_times = None
         self._shapes = None
+        self._window_index = None
+        self._departures = {}
+        self._departure_board = None
         self._stops_freq = None
         self._lines_freq = None
         self._segments = None
+        self._shape_hashes = None
         self._segments_freq = None
         self._speeds = None
+        self._windowed_speeds = None
         self._avg_speeds = None
+        self._speed_distribution = None
         self._dist_matrix = None
+        self._transfer_graphs = {}
+        self._timetable = None
         self._dates_service_id = None
+        self._metric_crs = None
+        self._transformer = None
+        self._projected_stops = None
+        self._projected_shapes = None
+        self._projected_segments = None
+        self._spatial_indexes = {}
 
 
     @property
@@ -94,6 +114,21 @@ class Feed:
     def time_windows(self):
         return self._time_windows
 
+    @time_windows.setter
+    def time_windows(self, value):
+        """
+        Changes the time windows of the feed. Only the products that depend on
+        the windows are dropped, so they get recomputed from the cached
+        stop_times, segments and speeds the next time they are accessed.
+        """
+        self._time_windows = value
+        self._stops_freq = None
+        self._lines_freq = None
+        self._segments_freq = None
+        self._windowed_speeds = None
+        self._avg_speeds = None
+        self._speed_distribution = None
+
     @property
     def service_ids(self):
         return self._service_ids
@@ -106,6 +141,10 @@ class Feed:
     def geo(self):
         return self._geo
 
+    @property
+    def n_jobs(self):
+        return self._n_jobs
+
     @property
     def files(self):
         if self._files is None:
@@ -232,6 +271,24 @@ class Feed:
 
         return self._shapes
 
+    @property
+    def window_index(self):
+        """
+        Time windows of stop_times for the current time_windows, shared by
+        stops_freq, lines_freq and segments_freq.
+        """
+        if self._window_index is None or self._window_index["cutoffs"] != list(self.time_windows):
+            self._window_index = self.get_window_index()
+
+        return self._window_index
+
+    @property
+    def departure_board(self):
+        if self._departure_board is None:
+            self._departure_board = self.get_departure_board()
+
+        return self._departure_board
+
     @property
     def stops_freq(self):
         if self._stops_freq is None:
@@ -253,6 +310,16 @@ class Feed:
 
         return self._segments
 
+    @property
+    def shape_hashes(self):
+        """
+        Content hash of the vertices and stops of each shape, computed with the segments.
+        """
+        if self._shape_hashes is None:
+            self._segments = self.get_segments()
+
+        return self._shape_hashes
+
     @property
     def segments_freq(self):
         if self._segments_freq is None:
@@ -267,6 +334,17 @@ class Feed:
 
         return self._speeds
 
+    @property
+    def windowed_speeds(self):
+        """
+        Speeds of each stop time in its time window with outliers fixed,
+        shared by avg_speeds and speed_distribution.
+        """
+        if self._windowed_speeds is None:
+            self._windowed_speeds = self.get_windowed_speeds()
+
+        return self._windowed_speeds
+
     @property
     def avg_speeds(self):
         if self._avg_speeds is None:
@@ -274,6 +352,13 @@ class Feed:
 
         return self._avg_speeds
 
+    @property
+    def speed_distribution(self):
+        if self._speed_distribution is None:
+            self._speed_distribution = self.get_speed_distribution()
+
+        return self._speed_distribution
+
     @property
     def distance_matrix(self):
         if self._dist_matrix is None:
@@ -281,12 +366,71 @@ class Feed:
 
         return self._dist_matrix
 
+    @property
+    def transfer_graph(self):
+        """
+        Walking transfer graph with the default parameters of get_transfer_graph.
+        """
+        return self.get_transfer_graph()
+
+    @property
+    def timetable(self):
+        """
+        Timetable of the feed flattened into numpy arrays for journey planning.
+        """
+        if self._timetable is None:
+            self._timetable = build_timetable(self.stop_times, self.trips_patterns, self.stops.stop_id.values)
+
+        return self._timetable
+
     @property
     def dates_service_id(self):
         if self._dates_service_id is None:
             self._dates_service_id = self.get_dates_service_id()
         return self._dates_service_id
 
+    @property
+    def metric_crs(self):
+        """
+        Local metric CRS of the feed, picked once from its bounding box.
+        """
+        if self._metric_crs is None:
+            self._metric_crs = self.get_metric_crs()
+        return self._metric_crs
+
+    @property
+    def transformer(self):
+        """
+        Cached transformer from lon/lat to the metric CRS of the feed.
+        """
+        if self._transformer is None:
+            self._transformer = Transformer.from_crs(4326, self.metric_crs, always_xy=True)
+        return self._transformer
+
+    @property
+    def projected_stops(self):
+        if self._projected_stops is None:
+            self._projected_stops = self.get_projected_stops()
+        return self._projected_stops
+
+    @property
+    def projected_shapes(self):
+        if self._projected_shapes is None:
+            self._projected_shapes = self.get_projected_shapes()
+        return self._projected_shapes
+
+    @property
+    def projected_segments(self):
+        """
+        Segments in the metric CRS of the feed, kept from the projection that
+        measures their lengths when they are cut.
+        """
+        # Cutting the segments projects them too
+        self.segments
+        if self._projected_segments is None:
+            self._projected_segments = self.get_projected_segments()
+        return self._projected_segments
+
     @trips.setter
     def trips(self, value):
         self._trips = value
@@ -361,6 +505,91 @@ class Feed:
 
         return geo
 
+    def get_metric_crs(self):
+        coords = np.array(self.bbox["coordinates"][0])
+        min_lon, min_lat = coords.min(axis=0)
+        max_lon, max_lat = coords.max(axis=0)
+
+        return local_metric_crs(min_lon, min_lat, max_lon, max_lat)
+
+    def get_projected_stops(self):
+        """
+        Returns the stops projected to the metric CRS of the feed.
+        """
+        stops = pd.DataFrame(self.stops).drop("geometry", axis=1, errors="ignore")
+        x, y = self.transformer.transform(stops.stop_lon.values, stops.stop_lat.values)
+
+        return gpd.GeoDataFrame(data=stops, geometry=gpd.points_from_xy(x, y), crs=self.metric_crs)
+
+    def get_projected_shapes(self):
+        """
+        Returns the shapes projected to the metric CRS of the feed.
+        """
+        shapes = self.shapes
+        geometry = project_geometries(shapes.geometry.values, self.transformer)
+
+        return gpd.GeoDataFrame(data=shapes.drop("geometry", axis=1), geometry=geometry, crs=self.metric_crs)
+
+    def get_projected_segments(self):
+        """
+        Returns the segments projected to the metric CRS of the feed.
+        """
+        segments = self.segments
+        geometry = project_geometries(segments.geometry.values, self.transformer)
+
+        return gpd.GeoDataFrame(data=segments.drop("geometry", axis=1), geometry=geometry, crs=self.metric_crs)
+
+    def get_spatial_index(self, layer: str = "stops"):
+        """
+        STRtree over the geometries of a layer ("stops", "shapes" or "segments")
+        projected to the metric CRS of the feed. Built on first use and cached.
+        Positions in the tree are row positions in Feed.stops, Feed.shapes or
+        Feed.segments.
+        """
+        if layer not in self._spatial_indexes:
+            if layer == "stops":
+                geometry = self.projected_stops.geometry.values
+            elif layer == "shapes":
+                geometry = self.projected_shapes.geometry.values
+            elif layer == "segments":
+                geometry = self.projected_segments.geometry.values
+            else:
+                raise ValueError(f'layer must be "stops", "shapes" or "segments", not "{layer}"')
+
+            logging.info(f"Building the spatial index of {layer}")
+            self._spatial_indexes[layer] = shapely.STRtree(np.asarray(geometry))
+
+        return self._spatial_indexes[layer]
+
+    def query_polygon(self, layer: str, polygon, predicate: str = "intersects"):
+        """
+        Row positions of the stops, shapes or segments that satisfy the predicate
+        with a polygon (or any shapely geometry) in lon/lat, e.g. the stops
+        within a district or the segments that touch a corridor.
+        """
+        tree = self.get_spatial_index(layer)
+        geometry = project_geometries(polygon, self.transformer)
+
+        return np.sort(tree.query(geometry, predicate=predicate))
+
+    def query_bbox(self, layer: str, bbox, predicate: str = "intersects"):
+        """
+        Row positions of the stops, shapes or segments that satisfy the predicate
+        with a (min_lon, min_lat, max_lon, max_lat) box.
+        """
+        polygon = shapely.segmentize(shapely.box(*bbox), max(bbox[2] - bbox[0], bbox[3] - bbox[1]) / 10)
+
+        return self.query_polygon(layer, polygon, predicate)
+
+    def query_nearest(self, layer: str, geometry, k: int = 1):
+        """
+        Row positions of the k stops, shapes or segments nearest to a shapely
+        geometry in lon/lat, nearest first, and their distances in meters.
+        """
+        tree = self.get_spatial_index(layer)
+
+        return nearest_k(tree, project_geometries(geometry, self.transformer), k)
+
     def get_dates(self):
         start_date = self.start_date
         end_date = self.end_date
@@ -467,19 +696,20 @@ class Feed:
         trips_with_stops = trips_with_stops.merge(
             route_patterns[["pattern_id", "route_pattern", "pattern_name"]], how="left"
         )
-        trips_with_patterns = trips_with_stops[
-            [
-                "trip_id",
-                "route_id",
-                "pattern_id",
-                "route_pattern",
-                "pattern_name",
-                "route_name",
-                "service_id",
-                "direction_id",
-                "shape_id",
-            ]
+        pattern_cols = [
+            "trip_id",
+            "route_id",
+            "pattern_id",
+            "route_pattern",
+            "pattern_name",
+            "route_name",
+            "service_id",
+            "direction_id",
+            "shape_id",
         ]
+        if "block_id" in trips_with_stops.columns:
+            pattern_cols.append("block_id")
+        trips_with_patterns = trips_with_stops[pattern_cols]
 
         return trips_with_patterns.copy(), route_patterns.copy()
 
@@ -699,10 +929,14 @@ class Feed:
             "direction_id",
             "shape_id",
         ]
+        # Blocks are kept when the feed has them to follow interlined vehicles
+        if "block_id" in trips.columns:
+            cols.append("block_id")
         trips = add_route_name(trips, routes).reindex(columns=cols)
 
-        # Fill null values
-        trips["direction_id"] = trips.direction_id.fillna(0)
+        # Fill null values. direction_id is an integer from here on, also when
+        # the feed doesn't have it
+        trips["direction_id"] = trips.direction_id.fillna(0).astype(int)
 
         return trips
 
@@ -802,23 +1036,48 @@ class Feed:
             shapes["shape_id"] = shapes.shape_id.astype(str)
             return shapes
 
+    def get_window_index(self):
+        """
+        Puts every stop time in its time window once, without modifying stop_times.
+
+        Returns a dictionary with the cutoffs and labels of the windows and the
+        number of trips per route, shape, stop, direction, first stop flag and
+        integer window code, ready to be aggregated by the frequency products.
+        """
+        stop_times = self.stop_times
+        cutoffs = list(self.time_windows)
+
+        codes = window_codes(stop_times.departure_time.values, cutoffs)
+
+        keys = ["route_id", "route_name", "shape_id", "stop_id", "direction_id"]
+        in_window = codes >= 0
+        counts = (
+            stop_times.loc[in_window, keys]
+            .assign(first_stop=(stop_times.stop_sequence.values == 1)[in_window], window_code=codes[in_window])
+            .groupby(keys + ["first_stop", "window_code"], dropna=False)
+            .size()
+            .rename("ntrips")
+            .reset_index()
+        )
+
+        return {
+            "cutoffs": cutoffs,
+            "labels": label_creation(cutoffs),
+            "counts": counts,
+        }
+
     def get_stops_freq(self):
         """
         Get the stop frequencies. For each stop of each route it
         returns the bus frequency in minutes/bus broken down by
         time window.
         """
-        stop_times = self.stop_times
+        window_index = self.window_index
         stops = self.stops
-        cutoffs = self.time_windows
 
-        if "window" not in stop_times.columns:
-            stop_times = window_creation(stop_times, cutoffs)
-        else:
-            stop_times["window"] = stop_times.window.astype(str)
-
-        labels = label_creation(cutoffs)
-        stop_frequencies = add_frequency(stop_times, labels, index_="stop_id", col="window", cutoffs=cutoffs)
+        stop_frequencies = window_frequency(
+            window_index["counts"], ["stop_id"], window_index["labels"], window_index["cutoffs"]
+        )
 
         if self.geo:
             stops_cols = ["stop_id", "stop_name", "geometry"]
@@ -839,28 +1098,16 @@ class Feed:
         time window.
         """
 
-        stop_times = self.stop_times
+        window_index = self.window_index
         shapes = self.shapes
-        cutoffs = self.time_windows
-
-        stop_times_first = stop_times.loc[stop_times.stop_sequence == 1, :]
-
-        # Create time windows
-        if "window" not in stop_times_first.columns:
-            stop_times_first = window_creation(stop_times_first, cutoffs)
-        else:
-            stop_times_first["window"] = stop_times_first.window.astype(str)
-
-        # Create labels
-        labels = label_creation(cutoffs)
-
-        # Get frequencies
-        line_frequencies = add_frequency(
-            stop_times_first,
-            labels,
-            index_=["route_id", "route_name", "shape_id"],
-            col="window",
-            cutoffs=cutoffs,
+        counts = window_index["counts"]
+
+        # Get frequencies from the first stop of each trip
+        line_frequencies = window_frequency(
+            counts.loc[counts.first_stop],
+            ["route_id", "route_name", "shape_id"],
+            window_index["labels"],
+            window_index["cutoffs"],
         )
 
         # Do we want a geodataframe?
@@ -883,102 +1130,359 @@ class Feed:
 
         return line_frequencies
 
-    def get_segments(self):
+    def get_departures(self, level: str = "stops", wrap: bool = True):
+        """
+        Returns the departures of stop_times grouped by the keys of a
+        frequency level, as sorted arrays (see sorted_departures).
+        Levels are "stops", "lines" (first stop of each trip) and "segments".
+        With wrap=True the times after 24:00 go to the beginning of the day.
+        The arrays are computed once per level and cached.
+        """
+        level_keys = {
+            "stops": ["stop_id", "direction_id"],
+            "lines": ["route_id", "route_name", "shape_id", "direction_id"],
+            "segments": ["route_id", "route_name", "stop_id", "direction_id"],
+        }
+        if level not in level_keys:
+            raise ValueError(f"Unknown level {level}, use one of {list(level_keys)}")
+
+        if (level, wrap) not in self._departures:
+            stop_times = self.stop_times
+            if level == "lines":
+                stop_times = stop_times.loc[stop_times.stop_sequence == 1]
+
+            times = np.asarray(stop_times.departure_time.values, dtype=float)
+            if wrap:
+                times = np.where(times >= 24 * 3600, times - 24 * 3600, times)
+
+            self._departures[(level, wrap)] = sorted_departures(stop_times[level_keys[level]], times)
+
+        return self._departures[(level, wrap)]
+
+    def get_departure_board(self):
+        """
+        Departures of every stop sorted by time, for next departure lookups.
+        Times after 24:00 are kept as they are. Besides the arrays of
+        departure_board it holds the trip_id, route and pattern code of each
+        sorted departure, and the values of the codes.
+        """
+        logging.info("Building the departure board")
+        stop_times = self.stop_times.merge(self.trips_patterns[["trip_id", "pattern_id"]], how="left")
+        stop_codes = pd.Index(self.stops.stop_id).get_indexer(stop_times.stop_id)
+        known = stop_codes >= 0
+        stop_times = stop_times.loc[known]
+
+        board = departure_board(stop_codes[known], stop_times.departure_time.values, len(self.stops))
+        sorted_stop_times = stop_times.iloc[board["order"]]
+
+        routes = sorted_stop_times.groupby(["route_id", "route_name", "direction_id"], sort=True, dropna=False)
+        pattern_codes, patterns = pd.factorize(sorted_stop_times.pattern_id)
+
+        board["trip_ids"] = sorted_stop_times.trip_id.values
+        board["route_codes"] = routes.ngroup().values
+        board["routes"] = routes.size().index.to_frame(index=False)
+        board["pattern_codes"] = pattern_codes
+        board["patterns"] = np.asarray(patterns)
+
+        return board
+
+    def _board_rows(self, stop_ids, times, positions):
+        """
+        Table of the departures at the given positions of the departure board,
+        one row per query (stop_id and time) and departure.
+        """
+        board = self.departure_board
+        routes = board["routes"]
+        route_codes = board["route_codes"][positions]
+
+        departures = pd.DataFrame({"stop_id": stop_ids, "time": times})
+        departures["departure_time"] = board["times"][positions]
+        departures["trip_id"] = board["trip_ids"][positions]
+        for col in routes.columns:
+            departures[col] = routes[col].values[route_codes]
+        departures["pattern_id"] = board["patterns"][board["pattern_codes"][positions]]
+
+        return departures
+
+    def _stop_codes(self, stop_ids):
+        stop_ids = np.atleast_1d(stop_ids)
+        stop_codes = pd.Index(self.stops.stop_id).get_indexer(stop_ids)
+        if (stop_codes < 0).any():
+            raise KeyError(f"Unknown stops: {list(stop_ids[stop_codes < 0])}")
+
+        return stop_ids, stop_codes
+
+    def get_next_departures(self, stop_ids, times, k: int = 3):
+        """
+        Next k departures at or after each of times from each of stop_ids.
+        Takes a single stop and time or arrays of them, e.g. thousands of
+        stop/time pairs in one call. Times are seconds since midnight or
+        "HH:MM:SS" strings.
+
+        Returns one row per query and departure, with the query stop_id and
+        time, the departure_time, trip, route and pattern, and the rank of the
+        departure (0 for the next one).
+        """
+        stop_ids, stop_codes = self._stop_codes(stop_ids)
+        times = np.broadcast_to(parse_times(times), stop_ids.shape)
+
+        board = self.departure_board
+        first = board_search(board, stop_codes, times)
+        positions = first[:, None] + np.arange(k)
+        query, rank = np.nonzero(positions < board["offsets"][stop_codes + 1][:, None])
+
+        departures = self._board_rows(stop_ids[query], times[query], positions[query, rank])
+        departures.insert(2, "rank", rank)
+
+        return departures
+
+    def get_departures_between(self, stop_ids, start, end):
+        """
+        Departures from each of stop_ids in [start, end), with the same
+        inputs and columns as get_next_departures but without rank.
+        start and end can be single times or one per stop.
+        """
+        stop_ids, stop_codes = self._stop_codes(stop_ids)
+        start = np.broadcast_to(parse_times(start), stop_ids.shape)
+        end = np.broadcast_to(parse_times(end), stop_ids.shape)
+
+        board = self.departure_board
+        first = board_search(board, stop_codes, start)
+        last = np.maximum(board_search(board, stop_codes, end), first)
+
+        # Every position between first and last of each query
+        n_departures = last - first
+        query = np.repeat(np.arange(len(stop_ids)), n_departures)
+        shift = np.cumsum(n_departures) - n_departures - first
+        positions = np.arange(n_departures.sum()) - np.repeat(shift, n_departures)
+
+        return self._board_rows(stop_ids[query], start[query], positions)
+
+    def get_vehicles_in_service(self, wrap: bool = True):
+        """
+        Vehicles in service at every minute of the day, per route and for
+        all the lines. A vehicle is in service from the first departure of a
+        trip until its last arrival or, when the feed has block_id, until the
+        next trip of its block starts, so layovers of interlined vehicles count
+        for the route they just ran.
+
+        With wrap=True the minutes after 24:00 are added to the beginning of
+        the day, otherwise the profile runs until the last arrival.
+        """
+        stop_times = self.stop_times
+        trips = self.trips
+
+        spans = stop_times.groupby("trip_id").agg(start=("departure_time", "min"), end=("arrival_time", "max"))
+        spans = trips.merge(spans, left_on="trip_id", right_index=True)
+        spans = spans.loc[spans.start.notnull() & spans.end.notnull()]
+
+        if "block_id" in spans.columns:
+            spans = spans.sort_values(["service_id", "block_id", "start"])
+            next_start = spans.groupby(["service_id", "block_id"]).start.shift(-1)
+            spans["end"] = np.where(next_start > spans.end, next_start, spans.end)
+
+        routes = spans.groupby(["route_id", "route_name"], sort=True)
+        profile = vehicles_in_service(
+            routes.ngroup().values, spans.start.values, spans.end.values, routes.ngroups, wrap
+        )
+        profile = np.vstack([profile, profile.sum(axis=0)])
+
+        route_values = routes.size().index.to_frame(index=False)
+        route_values.loc[len(route_values)] = ["ALL_LINES", "All lines"]
+
+        n_minutes = profile.shape[1]
+        minutes = np.arange(n_minutes)
+        vehicles = route_values.loc[np.repeat(route_values.index, n_minutes)].reset_index(drop=True)
+        vehicles["minute"] = np.tile(minutes, len(route_values))
+        vehicles["time"] = np.tile([f"{m // 60}:{m % 60:02d}" for m in minutes], len(route_values))
+        vehicles["vehicles"] = profile.ravel()
+
+        return vehicles
+
+    def get_peak_vehicles(self, wrap: bool = True):
+        """
+        Peak number of vehicles in service per route and for all the lines,
+        with the first minute of the day when it happens.
+        """
+        vehicles = self.get_vehicles_in_service(wrap)
+        peaks = vehicles.loc[vehicles.groupby(["route_id", "route_name"], sort=False).vehicles.idxmax()]
+
+        return peaks.rename(columns={"vehicles": "peak_vehicles"}).reset_index(drop=True)
+
+    def get_rolling_freq(
+        self,
+        level: str = "stops",
+        window: float = 60,
+        step: float = 5,
+        start: float = 0,
+        end: float = 24,
+    ):
+        """
+        Rolling frequencies. For each key of the level ("stops", "lines" or
+        "segments") it returns the number of trips and the minutes per trip in
+        windows of `window` minutes starting every `step` minutes, between the
+        hours start and end.
+
+        For a single arbitrary interval use window=(end - start) * 60.
+
+        min_per_trip is in whole minutes, as in the fixed-window tables, and
+        missing (pd.NA) for the windows without trips.
+        """
+        key_values, offsets, sorted_times = self.get_departures(level, wrap=end <= 24)
+
+        # Start of every window, in seconds
+        last_start = max(start * 60, end * 60 - window)
+        starts = np.arange(start * 60, last_start + 1e-9, step) * 60
+
+        ntrips = count_departures(offsets, sorted_times, starts, window * 60)
+
+        freq = key_values.loc[np.repeat(np.arange(len(key_values)), len(starts))].reset_index(drop=True)
+        freq["window_start"] = np.tile(starts / 3600, len(key_values))
+        labels = [
+            f"{m // 60}:{m % 60:02d}-{(m + int(window)) // 60}:{(m + int(window)) % 60:02d}"
+            for m in (starts // 60).astype(int)
+        ]
+        freq["window"] = np.tile(labels, len(key_values))
+        freq["ntrips"] = ntrips.ravel()
+        # Whole minutes as in the fixed windows, missing for windows without trips
+        freq["min_per_trip"] = np.trunc(window / freq.ntrips.replace(0, np.nan)).astype("Int64")
+
+        if level == "segments":
+            segment_cols = [
+                "route_id",
+                "route_name",
+                "direction_id",
+                "start_stop_id",
+                "end_stop_id",
+                "segment_id",
+                "segment_name",
+            ]
+            segments = self.segments[segment_cols].drop_duplicates(
+                subset=["route_id", "route_name", "direction_id", "start_stop_id"]
+            )
+            freq = freq.merge(segments.rename(columns={"start_stop_id": "stop_id"}), how="inner").rename(
+                columns={"stop_id": "start_stop_id"}
+            )
+
+        return freq
+
+    def get_segments(self, n_jobs: int = None, previous: dict = None):
         """Splits each route's shape into stop-stop LineString called segments
 
         Returns the segment geometry as well as additional segment information
+
+        With n_jobs > 1 the shapes are split into chunks with a similar number
+        of vertices that are cut in a pool of n_jobs processes (-1 uses all cores).
+        Defaults to the n_jobs of the feed.
+
+        previous is a Feed.snapshot() of an older version of the feed. Shapes
+        whose vertices and stops did not change reuse its segments and only the
+        rest are cut again. Defaults to the previous snapshot of the feed.
+
+        Segments are cut in lon/lat. Their coordinates are projected to the metric
+        CRS of the feed in one transform, to measure their lengths, and the projected
+        lines are kept in Feed.projected_segments.
         """
         logging.info("Getting segments...")
         stop_times = self.stop_times
         shapes = self.shapes
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        previous = self._previous if previous is None else previous
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
 
         req_columns = ["shape_id", "stop_sequence", "stop_id", "geometry"]
         add_columns = ["route_id", "route_name", "direction_id", "stop_name"]
 
-        # merge stop_times and shapes to calculate cut distance and interpolated point
+        # keep the stops of the shapes we know about, grouped by shape
         df_shape_stop = (
             stop_times[req_columns + add_columns]
             .drop_duplicates()
-            .merge(shapes, on="shape_id", suffixes=("_stop", "_shape"))
-        )
-        logging.info("Projecting stops onto shape...")
-        df_shape_stop["cut_distance_stop_point"] = df_shape_stop[["geometry_stop", "geometry_shape"]].apply(
-            lambda x: x[1].project(x[0], normalized=True), axis=1
-        )
-        logging.info("Interpolating stops onto shape...")
-        df_shape_stop["projected_stop_point"] = df_shape_stop[["geometry_shape", "cut_distance_stop_point"]].apply(
-            lambda x: x[0].interpolate(x[1], normalized=True), axis=1
-        )
-
-        # calculate cut distance for
-        logging.info("Sorting shape points and stops...")
-        df_shape = shapes[shapes.shape_id.isin(stop_times.shape_id.unique())]
-        df_shape["list_of_points"] = df_shape.geometry.apply(lambda x: list(MultiPoint(x.coords).geoms))
-        df_shape_exp = df_shape.explode("list_of_points")
-        df_shape_exp["projected_line_points"] = df_shape_exp[["geometry", "list_of_points"]].apply(
-            lambda x: x[0].project(x[1], normalized=True), axis=1
-        )
-
-        # rename both dfs to concatenate
-        df_shape_stop.rename(
-            {
-                "projected_stop_point": "geometry",
-                "cut_distance_stop_point": "normalized_distance_along_shape",
-            },
-            axis=1,
-            inplace=True,
-        )
-        df_shape_stop["cut_flag"] = True
-
-        df_shape_exp = df_shape_exp[["shape_id", "list_of_points", "projected_line_points"]]
-        df_shape_exp.rename(
-            {
-                "list_of_points": "geometry",
-                "projected_line_points": "normalized_distance_along_shape",
-            },
-            axis=1,
-            inplace=True,
+            .merge(shapes[["shape_id"]], on="shape_id")
+            .sort_values("shape_id", kind="stable")
+            .reset_index(drop=True)
         )
-
-        df_shape_exp["cut_flag"] = False
-
-        # combine stops and shape points
-        gdf = pd.concat([df_shape_stop, df_shape_exp], ignore_index=False)
-        gdf = gdf.sort_values(["shape_id", "normalized_distance_along_shape"])
-        gdf = gdf.reset_index(drop=True)
-        # debug_dataframe(gdf, 'combined_stops')
-
-        # drop all non stops (had to combine first fto get their gdf index)
-        cuts = gdf.where(gdf.cut_flag).dropna(subset="cut_flag")
+        stop_geoms = df_shape_stop.geometry.values
+        stop_coords = np.column_stack([shapely.get_x(stop_geoms), shapely.get_y(stop_geoms)])
+        df_shape_stop = pd.DataFrame(df_shape_stop.drop("geometry", axis=1))
+
+        # shape vertices and stops as compact coordinate buffers indexed by shape
+        df_shape = shapes[shapes.shape_id.isin(df_shape_stop.shape_id.unique())].sort_values("shape_id")
+        shape_ids = df_shape.shape_id.values
+        vertex_coords = shapely.get_coordinates(df_shape.geometry.values)
+        vertex_offsets = np.concatenate([[0], np.cumsum(shapely.get_num_coordinates(df_shape.geometry.values))])
+        stop_shape = np.searchsorted(shape_ids, df_shape_stop.shape_id.values)
+        stop_offsets = np.concatenate([[0], np.cumsum(np.bincount(stop_shape, minlength=len(shape_ids)))])
+
+        # Content hash of each shape, covering its vertices and every stop of its patterns
+        shape_hashes = shape_content_hashes(vertex_coords, vertex_offsets, df_shape_stop, stop_coords, stop_offsets)
+        self._shape_hashes = pd.Series(shape_hashes, index=shape_ids, name="shape_hash")
+
+        # Shapes that did not change since the previous snapshot keep their segments
+        unchanged = np.zeros(len(shape_ids), dtype=bool)
+        if previous is not None and previous["crs"] == self.metric_crs.to_wkt():
+            previous_hashes = previous["shape_hashes"]
+            known = np.isin(shape_ids, previous_hashes.index)
+            unchanged[known] = previous_hashes.loc[shape_ids[known]].values == shape_hashes[known]
+        elif previous is not None:
+            logging.info("The metric CRS of the previous snapshot is different, recomputing all segments.")
+
+        changed = np.flatnonzero(~unchanged)
+        logging.info(f"Cutting {len(changed)} of {len(shape_ids)} shapes into segments...")
+        chunks = [changed[c] for c in balanced_chunks(np.diff(vertex_offsets)[changed], n_jobs)]
+        chunk_stop_rows = []
+        args = []
+        for chunk in chunks:
+            vertex_rows, chunk_vertex_offsets = csr_take(vertex_offsets, chunk)
+            stop_rows, chunk_stop_offsets = csr_take(stop_offsets, chunk)
+            chunk_stop_rows.append(stop_rows)
+            args.append((vertex_coords[vertex_rows], chunk_vertex_offsets, stop_coords[stop_rows], chunk_stop_offsets))
+
+        if len(args) > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                results = list(pool.map(segment_shapes, *zip(*args)))
+        else:
+            results = [segment_shapes(*a) for a in args]
+
+        # put the cuts and segments of every chunk back in feed order.
+        # A cut is indexed by its position among all the sorted stops and vertices.
+        shape_start = vertex_offsets[:-1] + stop_offsets[:-1]
+        cut_rows, cut_index, segment_start, segment_geometries, segment_lengths = [], [], [], [], []
+        projected_geometries = []
+        for stop_rows, (cut_order, cut_position, segment_coords, segment_points) in zip(chunk_stop_rows, results):
+            rows = stop_rows[cut_order]
+            index = shape_start[stop_shape[rows]] + cut_position
+            same_shape = stop_shape[rows][:-1] == stop_shape[rows][1:]
+            cut_rows.append(rows)
+            cut_index.append(index)
+            segment_start.append(index[:-1][same_shape])
+            line_index = np.repeat(np.arange(len(segment_points)), segment_points)
+            projected_coords = project_coords(segment_coords, self.transformer)
+            segment_geometries.append(shapely.linestrings(segment_coords, indices=line_index))
+            projected_geometries.append(shapely.linestrings(projected_coords, indices=line_index))
+            segment_lengths.append(line_lengths(projected_coords, segment_points))
+
+        cut_rows = np.concatenate(cut_rows)
+        cut_index = np.concatenate(cut_index)
+        cut_order = np.argsort(cut_index)
+        segment_order = np.argsort(np.concatenate(segment_start))
+        segment_geometries = np.concatenate(segment_geometries)[segment_order]
+        projected_geometries = np.concatenate(projected_geometries)[segment_order]
+        segment_lengths = np.concatenate(segment_lengths)[segment_order]
+
+        cuts = df_shape_stop.iloc[cut_rows[cut_order]]
+        cuts.index = cut_index[cut_order]
         cuts = cuts.astype({"shape_id": str, "stop_sequence": int, "direction_id": int})
         cuts[["end_stop_id", "end_stop_name"]] = cuts.groupby("shape_id")[["stop_id", "stop_name"]].shift(-1)
 
-        # Create LineString for each stop to stop
-        segment_geometries = []
-        for shape_id in cuts.shape_id.drop_duplicates():
-            cut_idx = cuts[cuts.shape_id == shape_id].index
-            for i, cut in enumerate(cut_idx[:-1]):
-                segment_geometries.append(LineString(gdf.iloc[cut_idx[i] : cut_idx[i + 1] + 1].geometry))
-
         # create into gpd adding additional columns
         segment_df = cuts.dropna(subset="end_stop_id", axis=0)
         logging.info(f"segments_df: {len(segment_df)}, geometry: {len(segment_geometries)}")
-        segment_gdf = gpd.GeoDataFrame(segment_df, geometry=segment_geometries)
-        # drop irrelevant columns
-        segment_gdf.drop(
-            [
-                "geometry_shape",
-                "cut_flag",
-                "normalized_distance_along_shape",
-                "geometry_stop",
-            ],
-            axis=1,
-            inplace=True,
-        )
-        segment_gdf.crs = "EPSG:4326"
+        segment_gdf = gpd.GeoDataFrame(segment_df, geometry=segment_geometries, crs=4326)
+        segment_gdf.reset_index(drop=True, inplace=True)
 
         # Add segment length in meters
-        segment_gdf["distance_m"] = segment_gdf.to_crs(code(segment_gdf)).length
+        segment_gdf["distance_m"] = segment_lengths
 
         # Add segment_id and name
         segment_gdf["segment_id"] = segment_gdf.stop_id.astype(str) + " - " + segment_gdf.end_stop_id.astype(str)
@@ -1007,8 +1511,37 @@ class Feed:
             inplace=True,
         )
 
+        # Splice the segments of the unchanged shapes back in
+        if unchanged.any():
+            previous_segments = previous["segments"]
+            reused = previous_segments[previous_segments.shape_id.isin(shape_ids[unchanged])]
+            segment_gdf = pd.concat([reused, segment_gdf])
+            projected_geometries = np.concatenate(
+                [project_geometries(reused.geometry.values, self.transformer), projected_geometries]
+            )
+            order = np.argsort(segment_gdf.shape_id.values, kind="stable")
+            segment_gdf = segment_gdf.iloc[order].reset_index(drop=True)
+            projected_geometries = projected_geometries[order]
+
+        self._projected_segments = gpd.GeoDataFrame(
+            data=segment_gdf.drop("geometry", axis=1), geometry=projected_geometries, crs=self.metric_crs
+        )
+
         return segment_gdf
 
+    def snapshot(self):
+        """
+        Returns the derived tables needed to update this feed incrementally.
+
+        Pass it as `previous` to the Feed of a newer version of the GTFS so that
+        only the shapes whose vertices or stops changed are cut into segments again.
+        """
+        return {
+            "crs": self.metric_crs.to_wkt(),
+            "shape_hashes": self.shape_hashes,
+            "segments": self.segments,
+        }
+
     def get_speeds(self):
         stop_times = self.stop_times
         segment_gdf = self.segments
@@ -1042,19 +1575,23 @@ class Feed:
 
         return speeds[cols]
 
-    def get_avg_speeds(self):
+    def get_windowed_speeds(self):
         """
-        Calculate the average speed per route, segment and window.
+        Puts the speeds in their time windows and replaces the outliers
+        (over 120 km/h) by the average speed of their route, direction and window.
         """
-        speeds = self.speeds
-        segment_gdf = self.segments
-        cutoffs = self.time_windows
-
         # Create windows for aggregation
-        speeds = window_creation(speeds, cutoffs)
+        speeds = window_creation(self.speeds, self.time_windows)
 
         # Fix outliers
-        speeds = fix_outliers(speeds)
+        return fix_outliers(speeds)
+
+    def get_avg_speeds(self):
+        """
+        Calculate the average speed per route, segment and window.
+        """
+        speeds = self.windowed_speeds
+        segment_gdf = self.segments
 
         # Aggregate by route, segment, and window
         agg_speed = aggregate_speed(speeds, segment_gdf)
@@ -1069,50 +1606,72 @@ class Feed:
         if self.geo:
             data = gpd.GeoDataFrame(data=data, geometry=data.geometry, crs=4326)
 
-        ordered_cols = [
-            "route_id",
-            "route_name",
-            "direction_id",
-            "stop_sequence",
-            "segment_name",
-            "window",
-            "speed_kmh",
-            "avg_route_speed_kmh",
-            "segment_max_speed_kmh",
-            "runtime_sec",
-            "start_stop_name",
-            "end_stop_name",
-            "segment_id",
-            "start_stop_id",
-            "end_stop_id",
-            "shape_id",
-            "distance_m",
-            "geometry",
-        ]
+        ordered_cols = speed_table_columns(["speed_kmh", "avg_route_speed_kmh", "segment_max_speed_kmh", "runtime_sec"])
 
         return data[ordered_cols]
 
-    def get_segments_freq(self):
-
-        stop_times = self.stop_times
+    def get_speed_distribution(
+        self,
+        quantiles: list = None,
+        bins: list = None,
+    ):
+        """
+        Calculate the distribution of runtimes and speeds per route, segment and window.
+        Returns the quantiles of runtime_sec and speed_kmh and a histogram of speed_kmh
+        (bins in km/h, left-closed) in a sibling table of avg_speeds, from the same
+        windowed_speeds.
+        quantiles default to [0.15, 0.5, 0.85] and bins to [0, 10, 20, 30, 40, 50, 60, 80, inf].
+
+        Quantiles can't be merged, so those of the ALL LINES rows are computed from
+        the pooled speeds of every route on the segment, not from the route quantiles.
+        """
+        if quantiles is None:
+            quantiles = [0.15, 0.5, 0.85]
+        if bins is None:
+            bins = [0, 10, 20, 30, 40, 50, 60, 80, np.inf]
+        speeds = self.windowed_speeds
         segment_gdf = self.segments
-        cutoffs = self.time_windows
 
-        if "window" not in stop_times.columns:
-            stop_times = window_creation(stop_times, cutoffs)
-        else:
-            stop_times["window"] = stop_times.window.astype(str)
+        # Distribution by route, direction, segment and window
+        by_route = aggregate_speed_distribution(
+            speeds, ["route_name", "direction_id", "segment_id", "window"], quantiles, bins
+        )
+        by_route["direction_id"] = by_route.direction_id.astype(int)
+        segments = segment_gdf[SEGMENT_COLUMNS].astype({"direction_id": int})
+        by_route = pd.merge(by_route, segments, how="left").sort_values(
+            by=["route_id", "direction_id", "window", "stop_sequence"], ascending=True
+        )
 
-        # Get labels
-        labels = label_creation(cutoffs)
+        # Distribution by segment and window (ALL LINES level)
+        all_lines = aggregate_speed_distribution(speeds, ["segment_id", "window"], quantiles, bins)
+        all_lines = pd.merge(
+            all_lines,
+            segments.drop_duplicates(subset=["segment_id"]).drop(["route_name", "direction_id"], axis=1),
+            how="left",
+        ).sort_values(by=["window", "stop_sequence"], ascending=True)
+        all_lines["route_id"] = "ALL_LINES"
+        all_lines["route_name"] = "All lines"
+        all_lines["direction_id"] = "NA"
+
+        data = pd.concat([by_route, all_lines]).reset_index(drop=True)
+
+        # Do we want a geodataframe?
+        if self.geo:
+            data = gpd.GeoDataFrame(data=data, geometry=data.geometry, crs=4326)
+
+        dist_cols = [c for c in data.columns if c.startswith(("n_obs", "runtime_sec_p", "speed_kmh_"))]
+        return data[speed_table_columns(dist_cols)]
+
+    def get_segments_freq(self):
+
+        window_index = self.window_index
+        segment_gdf = self.segments
+        cutoffs = window_index["cutoffs"]
+        labels = window_index["labels"]
 
         # Aggregate trips
-        line_frequencies = add_frequency(
-            stop_times,
-            labels,
-            index_=["route_id", "route_name", "stop_id"],
-            col="window",
-            cutoffs=cutoffs,
+        line_frequencies = window_frequency(
+            window_index["counts"], ["route_id", "route_name", "stop_id"], labels, cutoffs
         )
 
         keep_these = [
@@ -1172,87 +1731,246 @@ class Feed:
 
         return data_complete
 
-    def get_distance_between_stops(self):
+    def get_distance_between_stops(self, radius: float = 500, walking_speed_kmh: float = 4):
         """
-        Compared H3 hex bins to DBSCAN clusters in this map:
-        https://studio.foursquare.com/public/8436b10c-4ccc-48a3-a232-e8026f81a117
+        Distance in meters between every pair of stops that are at most
+        `radius` meters apart, found with a KD-tree on the stops projected
+        to the metric CRS of the feed.
+        Returns a DataFrame with one row per ordered pair of stops and the
+        walking time between them at walking_speed_kmh.
+        """
+        stops = self.stops
 
-        From what I see, the optimal resolution for our purposes is resolution=9.
-        Taking the Hex bin at this resolution and its neighbors works as a better
-        clustering method than DBSCAN.
+        logging.info("Looking for stop distances")
+        st = time()
+        stop_index_1, stop_index_2, distances = stop_distance_pairs(self.projected_stops, radius)
 
-        We can then only calculate the distance between each stop and the ones that
-        are in the neighboring hex bins.
-        """
-        stops_ = self.stops.copy()
+        # Make dataframe
+        dist_df = pd.DataFrame({"stop_index_1": stop_index_1, "stop_index_2": stop_index_2, "distance_m": distances})
+
+        et = time()
+        logging.info(f"Calculating distances took {et-st} seconds")
+        logging.info("Calculate walking times")
 
-        logging.info("Getting hex bins.")
-        RESOLUTION = 9
+        # Calculate walking times
+        # By default 1.11 m/s as average walking speed as the literature suggests (4km/h=1.11 m/s)
+        walking_speed_ms = walking_speed_kmh / 3.6
+        dist_df["connection_time_min"] = dist_df.distance_m / walking_speed_ms / 60
 
-        stops_hash = stops_.to_dict()["stop_id"]
-        stops_.reset_index(inplace=True)
-        stops_.rename(columns=dict(index="stop_index"), inplace=True)
+        # Add stop_id to distance matrix
+        dist_df["stop_id_1"] = stops.stop_id.values[stop_index_1]
+        dist_df["stop_id_2"] = stops.stop_id.values[stop_index_2]
 
-        stops_["hex"] = stops_.apply(lambda row: latlng_to_cell(row.stop_lat, row.stop_lon, RESOLUTION), axis=1)
+        return dist_df
 
-        # stops.head()
+    def get_sparse_distance_matrix(self, radius: float = 500):
+        """
+        Same distances as get_distance_between_stops, as a scipy sparse matrix
+        where rows and columns are the positions of the stops in Feed.stops.
+        """
+        n_stops = len(self.stops)
+        stop_index_1, stop_index_2, distances = stop_distance_pairs(self.projected_stops, radius)
 
-        # Stops to utm for distance calculatin
-        utm_stops = stops_[["stop_index", "stop_id", "stop_name", "hex", "geometry"]].to_crs(code(stops_))
+        return csr_matrix((distances, (stop_index_1, stop_index_2)), shape=(n_stops, n_stops))
 
-        # # Hash for faster results
-        # stops_h3_hash = stops.set_index('stop_index').to_dict()['hex']
-        # h3_stops_hash = stops.set_index('hex').to_dict()['stop_index']
+    def get_transfer_graph(self, radius: float = 500, walking_speed_kmh: float = 4, parent_station: bool = True):
+        """
+        Footpaths between stops for transfer analysis.
 
-        # Stops in Hexbins
-        h3_stops = stops_.groupby("hex").stop_index.apply(list)
-        h3_geos = utm_stops.groupby("hex").geometry.apply(list)
+        Connects every pair of stops at most `radius` meters apart and, with
+        parent_station=True, every pair of stops of the same station (and each
+        stop with its station) whatever their distance.
 
-        #  Unique hex
-        h3_neighbors = {hex: grid_ring(hex, k=1) for hex in stops_.hex.unique()}
+        Returns a scipy CSR matrix where row i holds the neighbours of the stop in
+        position i of Feed.stops and the walking time to each of them in seconds.
+        Stops at the same location are kept as explicit entries of 0 seconds.
+        Graphs are cached in the feed for each set of parameters.
+        """
+        key = (radius, walking_speed_kmh, parent_station)
+        if key in self._transfer_graphs:
+            return self._transfer_graphs[key]
 
-        st = time()
+        stops = self.stops
+        projected_stops = self.projected_stops
+        n_stops = len(stops)
+
+        logging.info("Building the transfer graph")
+        stop_index_1, stop_index_2, _ = stop_distance_pairs(projected_stops, radius)
+        pairs = pd.DataFrame({"stop_index_1": stop_index_1, "stop_index_2": stop_index_2})
+
+        # Stops of the same station are always connected
+        if parent_station and "parent_station" in stops.columns:
+            station = stops.parent_station.where(stops.parent_station.notnull(), stops.stop_id).astype(str)
+            groups = pd.DataFrame({"station": station.values, "stop_index": np.arange(n_stops)})
+            same_station = groups.merge(groups, on="station", suffixes=("_1", "_2"))
+            same_station = same_station[same_station.stop_index_1 != same_station.stop_index_2]
+            pairs = pd.concat([pairs, same_station[["stop_index_1", "stop_index_2"]]]).drop_duplicates()
+
+        first = pairs.stop_index_1.values
+        second = pairs.stop_index_2.values
+        x = projected_stops.geometry.x.values
+        y = projected_stops.geometry.y.values
+        seconds = np.hypot(x[first] - x[second], y[first] - y[second]) / (walking_speed_kmh / 3.6)
+
+        graph = csr_matrix((seconds, (first, second)), shape=(n_stops, n_stops))
+        graph.sort_indices()
+        self._transfer_graphs[key] = graph
+
+        return graph
+
+    def get_earliest_arrival(
+        self,
+        stop_id: str,
+        departure_time,
+        max_rounds: int = 8,
+        radius: float = 500,
+        walking_speed_kmh: float = 4,
+    ):
+        """
+        Earliest arrival at every stop leaving from stop_id at departure_time,
+        in seconds since midnight or as a "HH:MM:SS" string.
 
-        stops_comb = []
-        distances = []
+        Journeys take up to max_rounds trips and can walk between stops as in
+        get_transfer_graph (radius=0 to not walk). Returns the reachable stops
+        with their arrival_time in seconds and travel_time in minutes.
+        """
+        return self.get_arrival_profile(
+            stop_id,
+            departure_times=[departure_time],
+            max_rounds=max_rounds,
+            radius=radius,
+            walking_speed_kmh=walking_speed_kmh,
+        ).drop(columns="departure_time")
+
+    def get_arrival_profile(
+        self,
+        stop_id: str,
+        start: float = 0,
+        end: float = 24,
+        step: float = 10,
+        departure_times: list = None,
+        max_rounds: int = 8,
+        radius: float = 500,
+        walking_speed_kmh: float = 4,
+        batch_size: int = 32,
+    ):
+        """
+        One-to-all profile. Earliest arrival at every stop leaving from stop_id
+        every `step` minutes between the hours start and end, or at each of
+        departure_times if given.
+
+        The departures are routed in batches of batch_size, which bounds the
+        memory of the arrival matrices (batch_size x stops) and of each walking
+        step (batch_size x transfers). Returns one row per departure_time and
+        reachable stop with the arrival_time in seconds and the travel_time in minutes.
+        """
+        if departure_times is None:
+            departure_times = np.arange(start * 3600, end * 3600 + 1e-9, step * 60)
+        departure_times = parse_times(departure_times)
 
-        logging.info("Looking for stop distances")
+        stops = self.stops
+        origin = pd.Index(stops.stop_id).get_loc(stop_id)
+        transfers = self.get_transfer_graph(radius, walking_speed_kmh) if radius > 0 else None
+
+        departure_index, stop_index, arrival_time = [], [], []
+        for i in range(0, len(departure_times), batch_size):
+            batch = departure_times[i : i + batch_size]
+            arrival = earliest_arrival(
+                self.timetable, np.full(len(batch), origin), batch, transfers=transfers, max_rounds=max_rounds
+            )
+            batch_index, batch_stops = np.nonzero(np.isfinite(arrival))
+            departure_index.append(batch_index + i)
+            stop_index.append(batch_stops)
+            arrival_time.append(arrival[batch_index, batch_stops])
+
+        departure_index = np.concatenate(departure_index) if departure_index else np.array([], dtype=int)
+        stop_index = np.concatenate(stop_index) if stop_index else np.array([], dtype=int)
+        profile = pd.DataFrame(
+            {
+                "departure_time": departure_times[departure_index],
+                "stop_id": stops.stop_id.values[stop_index],
+                "stop_name": stops.stop_name.values[stop_index],
+                "arrival_time": np.concatenate(arrival_time) if arrival_time else np.array([], dtype=float),
+            }
+        )
+        profile["travel_time"] = (profile.arrival_time - profile.departure_time) / 60
 
-        for hex, h3_group in h3_neighbors.items():
-            s_index = h3_stops[h3_stops.index.isin(h3_group)].values
-            s_geos = h3_geos[h3_geos.index.isin(h3_group)].values
+        return profile
 
-            stops_list = list(chain.from_iterable(s_index))
-            geo_list = list(chain.from_iterable(s_geos))
-            geo_perm = list(permutations(geo_list, 2))
+    def get_accessibility(
+        self,
+        minutes=30,
+        start: float = 7,
+        end: float = 9,
+        step: float = 15,
+        origins: list = None,
+        max_rounds: int = 8,
+        radius: float = 500,
+        walking_speed_kmh: float = 4,
+        n_jobs: int = None,
+        batch_size: int = 32,
+    ):
+        """
+        Accessibility from many origins. For each origin stop (all the stops by
+        default) and departure every `step` minutes between the hours start and
+        end, it returns how many stops can be reached within each of `minutes`.
 
-            stops_comb.extend(list(permutations(stops_list, 2)))
-            distances.extend([distance(pair[0], pair[1]) for pair in geo_perm])
+        The queries are routed in batches of batch_size, spread over a pool of
+        n_jobs processes (-1 uses all cores) that keep one copy of the timetable
+        each. Defaults to the n_jobs of the feed.
 
-        # Make dataframe
-        dist_df = pd.DataFrame(data=stops_comb, columns=["stop_index_1", "stop_index_2"])
-        dist_df["distance_m"] = distances
-        dist_df.drop_duplicates(subset=["stop_index_1", "stop_index_2"], inplace=True)
+        Returns one row per origin, departure_time and minutes with the number of
+        reachable_stops, not counting the origin.
+        """
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
 
-        et = time()
-        # print(f'Calculating distances took {et-st} seconds')
-        logging.info(f"Calculating distances took {et-st} seconds")
-        logging.info("Calculate walking times")
+        stops = self.stops
+        if origins is None:
+            origins = stops.stop_id.values
+        origin_index = pd.Index(stops.stop_id).get_indexer(origins)
+        if (origin_index < 0).any():
+            raise KeyError(f"Unknown origin stops: {list(np.asarray(origins)[origin_index < 0])}")
+
+        minutes = np.atleast_1d(minutes)
+        departure_times = np.arange(start * 3600, end * 3600 + 1e-9, step * 60)
+        transfers = self.get_transfer_graph(radius, walking_speed_kmh) if radius > 0 else None
+        timetable = self.timetable
+
+        # One query per origin and departure time
+        query_origins = np.repeat(origin_index, len(departure_times))
+        query_times = np.tile(departure_times, len(origin_index))
+        batches = [
+            (query_origins[i : i + batch_size], query_times[i : i + batch_size], minutes * 60)
+            for i in range(0, len(query_origins), batch_size)
+        ]
 
-        # Calculate walking times
-        # Assume 1.11 m/s as average walking speed as the literature suggests (4km/h=1.11 m/s)
-        walking_speed_ms = 4 / 3.6
-        dist_df["connection_time_min"] = dist_df.distance_m * walking_speed_ms / 60
+        logging.info(f"Routing {len(query_origins)} queries in {len(batches)} batches")
+        if n_jobs > 1 and len(batches) > 1:
+            with ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=init_worker, initargs=(timetable, transfers, max_rounds)
+            ) as pool:
+                results = list(pool.map(count_reachable, *zip(*batches)))
+        else:
+            init_worker(timetable, transfers, max_rounds)
+            results = [count_reachable(*b) for b in batches]
 
-        # Add stop_id to distance matrix
-        dist_df["stop_id_1"] = dist_df.stop_index_1.apply(lambda x: stops_hash[x])
-        dist_df["stop_id_2"] = dist_df.stop_index_2.apply(lambda x: stops_hash[x])
+        reachable = np.concatenate(results) if results else np.empty((0, len(minutes)), dtype=int)
 
-        return dist_df
+        return pd.DataFrame(
+            {
+                "stop_id": np.repeat(stops.stop_id.values[query_origins], len(minutes)),
+                "stop_name": np.repeat(stops.stop_name.values[query_origins], len(minutes)),
+                "departure_time": np.repeat(query_times, len(minutes)),
+                "minutes": np.tile(minutes, len(query_origins)),
+                "reachable_stops": reachable.ravel(),
+            }
+        )
 
 
 def extract_file(file, feed):
-    data_types = {"shape_id": str, "stop_id": str, "route_id": str, "trip_id": str}
+    data_types = {"shape_id": str, "stop_id": str, "route_id": str, "trip_id": str, "parent_station": str}
 
     files = feed.files
     gtfs_path = feed.gtfs_path
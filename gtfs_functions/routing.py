@@ -0,0 +1,267 @@
+"""
+Journey planning over the timetable of a Feed.
+
+Vectorized version of RAPTOR (round-based public transit routing). The
+timetable is flattened into contiguous numpy arrays once, and every round
+of the algorithm runs over all the routes and a whole batch of queries at
+the same time.
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+
+# Most walking transfers relaxed at once, so that a batch of queries never
+# needs more than (batch, WALK_CHUNK_EDGES) arrays however large the transfer graph is
+WALK_CHUNK_EDGES = 1 << 16
+
+
+def build_timetable(stop_times, trips, stop_ids):
+    """
+    Flattens the timetable into contiguous numpy arrays grouped by route.
+
+    Trips of the same pattern are split into routes where no trip overtakes
+    another one, as RAPTOR requires.
+    Input:
+        - stop_times: DataFrame with trip_id, stop_id, stop_sequence and
+          arrival_time and departure_time in seconds.
+        - trips: DataFrame with the trip_id and pattern_id of each trip.
+        - stop_ids: np.array with the stop_id of each stop position, as in Feed.stops.
+    Output:
+        - dictionary of np.arrays. Each (route, position along the route) pair is
+          a "route stop", and its times are stored contiguously, one per trip.
+    """
+    logging.info("Building the timetable arrays")
+    st = stop_times[["trip_id", "stop_id", "stop_sequence", "arrival_time", "departure_time"]].merge(
+        trips[["trip_id", "pattern_id"]]
+    )
+    st["arrival_time"] = st.arrival_time.fillna(st.departure_time).astype(float)
+    st["departure_time"] = st.departure_time.fillna(st.arrival_time).astype(float)
+    st["stop_index"] = pd.Index(stop_ids).get_indexer(st.stop_id)
+
+    # Trips without times or with unknown stops can't be used
+    bad_trips = st.loc[st.arrival_time.isnull() | (st.stop_index < 0), "trip_id"].unique()
+    st = st.loc[~st.trip_id.isin(bad_trips)]
+
+    # Trips of each pattern sorted by their first departure
+    first_departure = st.groupby("trip_id").departure_time.min().rename("first_departure")
+    st = st.merge(first_departure, left_on="trip_id", right_index=True).sort_values(
+        ["pattern_id", "first_departure", "trip_id", "stop_sequence"]
+    )
+
+    route_stops, route_n_stops, route_n_trips = [], [], []
+    arrival, departure, trip_ids = [], [], []
+
+    for _, pattern in st.groupby("pattern_id", sort=True):
+        n_stops = pattern.trip_id.value_counts().iloc[0]
+        if len(pattern) % n_stops:
+            logging.info(f"Pattern {pattern.pattern_id.iloc[0]} has trips with different stops, skipping it")
+            continue
+
+        pattern_trips = pattern.trip_id.values[::n_stops]
+        arr = pattern.arrival_time.values.reshape(-1, n_stops)
+        dep = pattern.departure_time.values.reshape(-1, n_stops)
+
+        # Split the pattern so that no trip overtakes another one
+        routes, last_trip = [], []
+        for t in range(len(pattern_trips)):
+            for r, last in enumerate(last_trip):
+                if (arr[t] >= arr[last]).all() and (dep[t] >= dep[last]).all():
+                    routes[r].append(t)
+                    last_trip[r] = t
+                    break
+            else:
+                routes.append([t])
+                last_trip.append(t)
+
+        for route in routes:
+            route_stops.append(pattern.stop_index.values[:n_stops])
+            route_n_stops.append(n_stops)
+            route_n_trips.append(len(route))
+            # Times stored by position along the route and then by trip
+            arrival.append(arr[route].T.ravel())
+            departure.append(dep[route].T.ravel())
+            trip_ids.append(pattern_trips[route])
+
+    route_n_stops = np.array(route_n_stops, dtype=int)
+    route_n_trips = np.array(route_n_trips, dtype=int)
+    departure = np.concatenate(departure) if departure else np.array([], dtype=float)
+
+    # Route stops: route of each one, number of trips and first time
+    n_route_stops = route_n_stops.sum()
+    route_stop_route = np.repeat(np.arange(len(route_n_stops)), route_n_stops)
+    route_stop_trips = route_n_trips[route_stop_route]
+    route_stop_offsets = np.concatenate([[0], np.cumsum(route_stop_trips)])
+
+    # Shift the departures of each route stop onto their own band of time,
+    # so the first catchable trip of every route stop is a single searchsorted
+    min_time = departure.min(initial=0)
+    max_time = departure.max(initial=0)
+    span = max_time - min_time + 1
+    banded_departure = departure + np.repeat(np.arange(n_route_stops) * span, route_stop_trips)
+
+    return {
+        "n_stops": len(stop_ids),
+        "route_stops": np.concatenate(route_stops) if route_stops else np.array([], dtype=int),
+        "route_stop_route": route_stop_route,
+        "route_stop_trips": route_stop_trips,
+        "route_stop_offsets": route_stop_offsets,
+        "route_trip_offsets": np.concatenate([[0], np.cumsum(route_n_trips)]),
+        "trip_ids": np.concatenate(trip_ids) if trip_ids else np.array([], dtype=object),
+        "arrival": np.concatenate(arrival) if arrival else np.array([], dtype=float),
+        "departure": departure,
+        "banded_departure": banded_departure,
+        "band": np.arange(n_route_stops) * span,
+        "min_time": min_time,
+        "max_time": max_time,
+    }
+
+
+def _group_minimum(values, order, starts, targets, n_targets):
+    """
+    Minimum of the columns of values that go to the same target.
+    order sorts the columns by target, and starts are the first sorted
+    column of each of the targets.
+    """
+    result = np.full((values.shape[0], n_targets), np.inf)
+    if len(order):
+        result[:, targets] = np.minimum.reduceat(values[:, order], starts, axis=1)
+    return result
+
+
+def _by_target(targets):
+    """
+    Sorts the columns that go to each target to reduce them with _group_minimum.
+    """
+    order = np.argsort(targets, kind="stable")
+    unique, starts = np.unique(targets[order], return_index=True)
+    return order, starts, unique
+
+
+def _walk_minimum(source, walk_from, walk_time, starts, targets, n_stops):
+    """
+    Earliest arrival at every stop walking one transfer from source.
+    The transfers are sorted by target, and starts are the first transfer of
+    each of the targets. They are relaxed in chunks of whole targets of at
+    most WALK_CHUNK_EDGES transfers (or a single target).
+    """
+    result = np.full((source.shape[0], n_stops), np.inf)
+    bounds = np.append(starts, len(walk_from))
+    i = 0
+    while i < len(starts):
+        j = max(np.searchsorted(bounds, bounds[i] + WALK_CHUNK_EDGES, side="right") - 1, i + 1)
+        lo, hi = bounds[i], bounds[j]
+        values = source[:, walk_from[lo:hi]]
+        values += walk_time[lo:hi]
+        result[:, targets[i:j]] = np.minimum.reduceat(values, starts[i:j] - lo, axis=1)
+        i = j
+    return result
+
+
+def earliest_arrival(timetable, origins, departure_times, transfers=None, max_rounds=8):
+    """
+    Earliest arrival at every stop for a batch of queries.
+    Input:
+        - timetable: dictionary returned by build_timetable.
+        - origins: np.array with the stop position of the origin of each query.
+        - departure_times: np.array with the departure time of each query,
+          in seconds since midnight.
+        - transfers: CSR matrix with the walking time in seconds between stops,
+          as returned by Feed.get_transfer_graph. None to not walk between stops.
+        - max_rounds: maximum number of trips of a journey.
+    Output:
+        - (n_queries, n_stops) np.array with the earliest arrival time at each stop,
+          in seconds since midnight. np.inf for the stops that can't be reached.
+    """
+    n_stops = timetable["n_stops"]
+    route_stops = timetable["route_stops"]
+    route_stop_route = timetable["route_stop_route"]
+    route_stop_trips = timetable["route_stop_trips"]
+    route_stop_offsets = timetable["route_stop_offsets"]
+    n_queries = len(origins)
+
+    # Route stops of the same route are consecutive. is_first marks the first one of each route.
+    is_first = np.ones(len(route_stops), dtype=bool)
+    is_first[1:] = route_stop_route[1:] != route_stop_route[:-1]
+    big = route_stop_trips.max(initial=0) + 2
+    ride_targets = _by_target(route_stops)
+
+    if transfers is not None:
+        # Transfers sorted by target once, so walking never reorders the columns
+        transfers = transfers.tocsr()
+        order, walk_starts, walk_targets = _by_target(transfers.indices)
+        walk_from = np.repeat(np.arange(n_stops), np.diff(transfers.indptr))[order]
+        walk_time = transfers.data[order]
+
+    def walk(source):
+        if transfers is None or len(walk_from) == 0:
+            return np.full_like(source, np.inf)
+        return _walk_minimum(source, walk_from, walk_time, walk_starts, walk_targets, n_stops)
+
+    def ride(tau):
+        # First trip that can be caught at every route stop
+        ready = np.clip(tau[:, route_stops], timetable["min_time"], timetable["max_time"] + 0.5)
+        position = np.searchsorted(timetable["banded_departure"], ready + timetable["band"])
+        trip_rank = position - route_stop_offsets[:-1]
+
+        # The best trip at each route stop is the earliest one caught before it along the route
+        running = np.maximum.accumulate(route_stop_route * big - trip_rank, axis=1)
+        boarded = route_stop_route * big - running
+        boarded = np.concatenate([np.full((n_queries, 1), big), boarded[:, :-1]], axis=1)
+        boarded[:, is_first] = big
+
+        can_ride = boarded < route_stop_trips
+        time_index = route_stop_offsets[:-1] + np.where(can_ride, boarded, 0)
+        time_index = np.minimum(time_index, len(timetable["arrival"]) - 1)
+        arrival = np.where(can_ride, timetable["arrival"][time_index], np.inf)
+
+        return _group_minimum(arrival, *ride_targets, n_stops)
+
+    tau = np.full((n_queries, n_stops), np.inf)
+    tau[np.arange(n_queries), origins] = departure_times
+    tau = np.minimum(tau, walk(tau))
+
+    for _ in range(max_rounds):
+        arrival = ride(tau)
+        improved = arrival < tau
+        if not improved.any():
+            break
+
+        tau = np.where(improved, arrival, tau)
+        tau = np.minimum(tau, walk(np.where(improved, tau, np.inf)))
+
+    return tau
+
+
+# Read-only arrays of the pool workers, set once per process by init_worker
+_shared = {}
+
+
+def init_worker(timetable, transfers, max_rounds):
+    """
+    Keeps the timetable and transfers of a pool worker so they are sent once
+    per process and not with every batch of queries.
+    """
+    _shared["timetable"] = timetable
+    _shared["transfers"] = transfers
+    _shared["max_rounds"] = max_rounds
+
+
+def count_reachable(origins, departure_times, budgets):
+    """
+    Number of stops reached from each origin within each of the time budgets.
+    Uses the arrays of init_worker.
+    Input:
+        - origins: np.array with the stop position of the origin of each query.
+        - departure_times: np.array with the departure time of each query in seconds.
+        - budgets: np.array with the time budgets in seconds.
+    Output:
+        - (n_queries, n_budgets) np.array with the number of stops reached,
+          not counting the origin.
+    """
+    arrival = earliest_arrival(
+        _shared["timetable"], origins, departure_times, _shared["transfers"], _shared["max_rounds"]
+    )
+    travel_time = arrival - departure_times[:, None]
+
+    return (travel_time[:, :, None] <= budgets).sum(axis=1) - 1
@@ -1,7 +1,12 @@
 import gtfs_functions
+import asyncio
 import logging
+import multiprocessing
 import os
 import pathlib
+import queue
+import threading
+import ridership_functions as rfx
 from nicegui import run, ui, context, app, events
 import pickle
 
@@ -18,6 +23,7 @@ class AppClass:
         self._feed = None
         self._needsPickling = False
         self._dialog = None
+        self.precompute = PrecomputeService()
         # self.get_route_dirs()
 
     @property
@@ -75,26 +81,6 @@ class AppClass:
         assert isinstance(other, ui.dialog)
         self._dialog = other
 
-    def load_feed(self):
-        """
-        Loads the feed. Designed to be run asynchronously by NiceGUI
-
-        For this reason, it returns the feed to be loaded into the main thread
-        of the object.
-        """
-        # TODO: refactor to enable weekends
-        sid = gtfs_functions.Feed(self.feedURI).busiest_service_id
-        self._feed = gtfs_functions.Feed(
-                                            self.feedURI, 
-                                            service_ids=[sid],
-                                            time_windows=[0,24]
-                                        )
-        logging.info("Loading GTFS Feed")
-        self.isFeedLoading = True
-        self.feed.avg_speeds
-        logging.info("GTFS Feed Loaded")
-        return self.feed
-    
     def clearMapLayers(self):
         self.mapLayers = {}
         self.edgesDict = {}
@@ -131,6 +117,135 @@ class AppClass:
 
         
 
+# Feed properties built by precompute_feed, in order, with their labels
+FEED_STAGES = [
+    ('trips', 'Reading trips'),
+    ('stop_times', 'Reading stop times'),
+    ('trips_patterns', 'Finding route patterns'),
+    ('segments', 'Cutting segments'),
+    ('avg_speeds', 'Calculating speeds'),
+    ('lines_freq', 'Counting trips'),
+]
+
+
+def precompute_feed(feedURI, messages):
+    """
+    Builds the feed of the busiest service ID of feedURI, one stage of
+        FEED_STAGES at a time. Designed to be run in a worker process
+
+    Puts ('stage', number, label) on the queue 'messages' as each stage
+        starts, and ('done', feed) or ('error', message) at the end
+    """
+    try:
+        messages.put(('stage', 0, 'Finding the busiest service'))
+        # TODO: refactor to enable weekends
+        sid = gtfs_functions.Feed(feedURI).busiest_service_id
+        feed = gtfs_functions.Feed(
+                                    feedURI,
+                                    service_ids=[sid],
+                                    time_windows=[0,24]
+                                )
+        for number, (attr, label) in enumerate(FEED_STAGES, start=1):
+            messages.put(('stage', number, label))
+            getattr(feed, attr)
+        messages.put(('done', feed))
+    except Exception as e:
+        messages.put(('error', repr(e)))
+
+
+class PrecomputeService:
+    """
+    Background work for the productivity monitor
+
+    loadFeed builds a feed in a worker process, keeping stage and progress
+        (0 to 1) up to date for the UI. precompute then builds the route
+        lookups and ridership aggregates in a thread (see
+        ridership_functions.precompute_lookups) while the user picks a
+        route. cancel stops both
+
+    The precompute thread shares the feed with the UI. UI handlers that read
+        the feed hold lock, which the thread takes one route at a time
+    """
+    def __init__(self):
+        self.stage = ''
+        self.progress = 0.0
+        self.isRunning = False
+        self.lock = threading.RLock()
+        self._process = None
+        self._cancel = threading.Event()
+
+    def _report(self, stage, progress):
+        self.stage = stage
+        self.progress = progress
+        logging.info(f'Precompute: {stage}')
+
+    async def loadFeed(self, feedURI, poll_interval = 0.25):
+        """
+        Returns the feed of feedURI, built in a worker process, or None if
+            cancelled. Raises a RuntimeError if building it fails or the
+            worker dies
+        """
+        self.cancel()
+        self._cancel = threading.Event()
+        messages = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=precompute_feed, args=(feedURI, messages), daemon=True)
+        self.isRunning = True
+        self._process.start()
+        n_stages = len(FEED_STAGES) + 1
+
+        try:
+            while True:
+                try:
+                    message = messages.get_nowait()
+                except queue.Empty:
+                    if not self._process.is_alive() and messages.empty():
+                        if self._cancel.is_set():
+                            self._report('Cancelled', 0.0)
+                            return None
+                        self._report('Failed', 0.0)
+                        raise RuntimeError(
+                            f'Could not load {feedURI}: the worker stopped '
+                            f'with exit code {self._process.exitcode}')
+                    await asyncio.sleep(poll_interval)
+                    continue
+
+                if message[0] == 'stage':
+                    self._report(message[2], message[1] / n_stages)
+                elif message[0] == 'done':
+                    self._report('Feed loaded', 1.0)
+                    return message[1]
+                else:
+                    self._report('Failed', 0.0)
+                    raise RuntimeError(f'Could not load {feedURI}: '
+                                       f'{message[1]}')
+        finally:
+            self._process.join(timeout=1)
+            self.isRunning = False
+
+    async def precompute(self, feed, csvURI):
+        """
+        Precomputes the lookups of feed and csvURI in a thread, stopping
+            any earlier precomputing
+        """
+        self._cancel.set()
+        self._cancel = threading.Event()
+        self._report('Indexing routes and ridership', 1.0)
+        await run.io_bound(rfx.precompute_lookups, feed, csvURI,
+                           cancel=self._cancel, lock=self.lock)
+        if not self._cancel.is_set():
+            self._report('Ready', 1.0)
+
+    def cancel(self):
+        """
+        Stops the feed worker process and any precomputing
+        """
+        self._cancel.set()
+        if self._process is not None and self._process.is_alive():
+            logging.info('Cancelling feed loading')
+            self._process.terminate()
+
+
 class InteractableModelItem:
     """
     A class defining for global values and related logic associated interactable
@@ -5,6 +5,12 @@ Author: Lilah Rosenfield || Utah Transit Authority
 11925@rideuta.com
 """
 
+import os
+import re
+import shutil
+import calendar
+import contextlib
+import weakref
 import pandas as pd
 import geopandas as geopd
 import shapely
@@ -12,11 +18,20 @@ import logging as log
 import sys
 import jenkspy
 import numpy as np
+from scipy.spatial import cKDTree
 # import folium
 from branca.colormap import LinearColormap
 CSV_PATH = '2024_January_Stops.csv'
 DEBUG_STEP = 0
 DEBUG_MODE = False
+RIDER_COLUMNS = ['LineAbbr', 'Direction', 'Service', 'StopId', 'AverageOn',
+                 'AverageOff', 'Sequence', 'AverageLoad', 'StopName']
+RIDER_LOCATION_COLUMNS = ['Latitude', 'Longitude']
+RIDER_AGGREGATION = {'AverageOn':'sum',
+                     'AverageOff':'sum',
+                     'AverageLoad':'sum',
+                     'Sequence':'max',
+                     'StopName':'max'}
 #import gtfs_functions
 # import gtfs_plots
 
@@ -26,6 +41,151 @@ if not sys.warnoptions:
 
 log.basicConfig(level=log.INFO)
 
+class RouteIndex:
+    """
+    Route-indexed view of a gtfs_functions Feed
+
+    Maps route numbers to route IDs, and (route_id, direction) to the rows
+        of avg_speeds, lines_freq and trips. Each table is grouped once, the
+        first time it is used, and grouped again only if the feed replaces
+        it (e.g. after changing time_windows).
+
+    Use get_route_index(feed) to share one index per feed.
+    """
+    TABLES = ['avg_speeds', 'lines_freq', 'trips']
+
+    def __init__(self, feed):
+        # Weak, so the index doesn't keep its feed (and the feed's key in
+        # _ROUTE_INDEXES) alive
+        self._feed = weakref.ref(feed)
+        self._route_ids = None
+        self._groups = {}
+
+    @property
+    def feed(self):
+        feed = self._feed()
+        if feed is None:
+            raise ReferenceError('The feed of this RouteIndex was deleted')
+        return feed
+
+    @property
+    def route_ids(self):
+        """
+        Dictionary of route number -> list of route IDs
+        """
+        if self._route_ids is None:
+            routes = self.feed.routes
+            self._route_ids = routes.groupby(
+                routes['route_short_name'].astype(str)
+                )['route_id'].agg(list).to_dict()
+        return self._route_ids
+
+    def route_id(self, route_num):
+        """
+        Gets GTFS route ID of route number 'route_num'
+
+        Raises a ValueError if it isn't in the feed or has several route IDs
+        """
+        route_num = str(route_num)
+        route_ids = self.route_ids.get(route_num, [])
+        if len(route_ids) < 1:
+            raise ValueError(f'Route number {route_num} not found in GTFS')
+        if len(route_ids) > 1:
+            raise ValueError(f'Route number {route_num} refers to multiple route IDs!')
+        return route_ids[0]
+
+    def _table_groups(self, table):
+        df = getattr(self.feed, table)
+        if table not in self._groups or self._groups[table][0] is not df:
+            log.info(f'Indexing {table} by route and direction')
+            by_route = df.groupby('route_id', sort=False).indices
+            by_direction = df.groupby(
+                [df['route_id'],
+                 pd.to_numeric(df['direction_id'], errors='coerce')],
+                sort=False).indices
+            self._groups[table] = (df, by_route, by_direction)
+        return self._groups[table]
+
+    def get(self, table, route_id, dir = None):
+        """
+        Returns the rows of 'table' ('avg_speeds', 'lines_freq' or 'trips')
+            for 'route_id' and optionally direction 'dir', in feed order.
+            Empty if there are none
+        """
+        df, by_route, by_direction = self._table_groups(table)
+        if dir is None:
+            rows = by_route.get(route_id, [])
+        else:
+            rows = by_direction.get((route_id, float(dir)), [])
+        return df.iloc[rows].copy()
+
+    def directions(self, route_id):
+        """
+        Returns the sorted directions that 'route_id' has in trips
+        """
+        _, _, by_direction = self._table_groups('trips')
+        return sorted(int(d) for r, d in by_direction if r == route_id)
+
+    def build(self):
+        """
+        Groups every table and the route numbers now instead of on first use
+        """
+        for table in self.TABLES:
+            self._table_groups(table)
+        self.route_ids
+
+
+_ROUTE_INDEXES = weakref.WeakKeyDictionary()
+
+def get_route_index(feed):
+    """
+    Returns the RouteIndex of 'feed', building it the first time
+    """
+    if feed not in _ROUTE_INDEXES:
+        _ROUTE_INDEXES[feed] = RouteIndex(feed)
+    return _ROUTE_INDEXES[feed]
+
+def precompute_lookups(feed, csvfile = None, stype = 'Weekday',
+                       cancel = None, lock = None):
+    """
+    Builds the RouteIndex of 'feed' and, given 'csvfile', the ridership
+        aggregates of each of its routes and directions ahead of time, so
+        that picking a route later is a lookup
+
+    Meant to be run in the background while the user picks a route. Stops
+        early if the threading.Event 'cancel' is set
+
+    The feed's lazy tables aren't thread safe. If other threads use the
+        feed, pass a 'lock' they also hold: it's taken while the index is
+        built and for each route's ridership, so they wait one step at most
+    """
+    lock = lock or contextlib.nullcontext()
+    log.info('Precomputing route lookups')
+    with lock:
+        index = get_route_index(feed)
+        index.build()
+        route_ids = dict(index.route_ids)
+    if csvfile is None:
+        return
+
+    with lock:
+        store = get_ridership_store(csvfile)
+    for route_num, ids in route_ids.items():
+        if len(ids) != 1:
+            continue
+        with lock:
+            dirs = index.directions(ids[0])
+        for dir in dirs:
+            if cancel is not None and cancel.is_set():
+                log.info('Precomputing cancelled')
+                return
+            try:
+                with lock:
+                    store.aggregate(route_num, dir, stype)
+            except ValueError:
+                pass # No ridership for this route
+    log.info('Route lookups precomputed')
+
 def route_id_from_route_num(feed, route_num):
     """
     Gets GTFS route ID given a feed and a route number
@@ -33,13 +193,7 @@ def route_id_from_route_num(feed, route_num):
     There cannot be any more than 1 instance of route_num
      in trip_short_name or the tool will fail
     """
-    route_num = str(route_num)
-    route_df = pd_filter(feed.routes, "route_short_name", route_num)
-    if len(route_df) < 1:
-        raise ValueError(f'Route number {route_num} not found in GTFS')
-    if len(route_df) > 1:
-        raise ValueError(f'Route number {route_num} refers to multiple route IDs!')
-    final = route_df.route_id.iloc[0]
+    final = get_route_index(feed).route_id(route_num)
     log.info(f'Route ID is {final}')
     return(final)
 
@@ -70,9 +224,296 @@ def pd_checkfilter(df, col, val):
                          f'in column {col} of the dataframe')
     return df
 
-def get_route_speed_segments(feed, route_id):
-    #route_id = route_id_from_route_num(feed, route_num)
-    return pd_filter(feed.avg_speeds,'route_id', route_id)
+def get_route_speed_segments(feed, route_id, dir = None):
+    """
+    Returns the avg_speeds segments of 'route_id', optionally only those
+        in direction 'dir'
+    """
+    return get_route_index(feed).get('avg_speeds', route_id, dir)
+
+class RidershipStore:
+    """
+    Cleaned APC data loaded once from 'csvfile'
+
+    LineAbbr, Direction and Service are kept as strings and StopId as an
+        integer. Rows are indexed by (LineAbbr, Direction, Service), so
+        getting the ridership of a route is a dictionary lookup instead of a
+        pass over the whole file.
+
+    Per-route aggregates are memoized. The same store can be passed instead
+        of a CSV path to every function that takes 'csvfile'.
+
+    Latitude and Longitude are kept when the file has them, for
+        match_stops_by_location
+    """
+    def __init__(self, csvfile, data = None):
+        self.csvfile = csvfile
+        if data is None:
+            log.info(f'Loading ridership from {csvfile}')
+            data = pd.read_csv(
+                csvfile, dtype={'LineAbbr': str, 'Service': str},
+                usecols=lambda c: c in RIDER_COLUMNS + RIDER_LOCATION_COLUMNS)
+
+        columns = RIDER_COLUMNS + [c for c in RIDER_LOCATION_COLUMNS
+                                   if c in data.columns]
+        self.data = normalize_ridership(data[columns])
+        self._index = self.data.groupby(
+            ['LineAbbr', 'Direction', 'Service']).indices
+        self._aggregates = {}
+
+    @classmethod
+    def from_dataset(cls, dataset, month, stype = None):
+        """
+        Returns the RidershipDataset of one month of a dataset made by
+            ingest_ridership, optionally of a single service type
+        """
+        return RidershipDataset(dataset, month, stype)
+
+    def get_rows(self, route_num, dir, stype = None):
+        """
+        Returns the ridership rows of route 'route_num' in direction 'dir'
+            and optionally service type 'stype'
+
+        Raises a ValueError like pd_checkfilter if there are none
+        """
+        route_num, dir = str(route_num), str(dir)
+        keys = [k for k in self._index if stype is None or k[2] == stype]
+        for col, val, pos in [('Service', stype, 2),
+                              ('LineAbbr', route_num, 0),
+                              ('Direction', dir, 1)]:
+            if val is None:
+                continue
+            keys = [k for k in keys if k[pos] == val]
+            if not keys:
+                raise ValueError(f'Value {val} was not found '
+                                 f'in column {col} of the dataframe')
+
+        rows = np.sort(np.concatenate([self._index[k] for k in keys]))
+        return self.data.iloc[rows]
+
+    def aggregate(self, route_num, dir, stype = None):
+        """
+        Ridership of route 'route_num' in direction 'dir' summed by stop,
+            as returned by agg_rider_data
+        """
+        key = (str(route_num), str(dir), stype)
+        if key not in self._aggregates:
+            df = self.get_rows(route_num, dir, stype)
+            self._aggregates[key] = df.groupby(['StopId']).agg(
+                RIDER_AGGREGATION)
+        return self._aggregates[key].copy()
+
+
+def normalize_ridership(df):
+    """
+    Normalizes the types of APC data: LineAbbr, Direction and Service as
+        strings and StopId as an integer (rows without StopId are dropped)
+    """
+    df = df.copy()
+    for col in ['LineAbbr', 'Direction', 'Service']:
+        df[col] = df[col].astype(str)
+
+    missing_stop = df['StopId'].isnull()
+    if missing_stop.any():
+        log.info(f'Dropping {missing_stop.sum()} ridership rows '
+                 f'without StopId')
+        df = df[~missing_stop]
+    df['StopId'] = df['StopId'].astype(int)
+    return df.reset_index(drop=True)
+
+def ridership_partitioning():
+    """
+    Partitioning of ridership datasets: hive-style month and Service folders
+
+    pyarrow is only imported here, in ingest_ridership / read_ridership and
+        in RidershipDataset, so the rest of the module works without it
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(
+        pa.schema([('month', pa.string()), ('Service', pa.string())]),
+        flavor='hive')
+
+def month_from_filename(csvfile):
+    """
+    Gets the month of an APC export named like '2024_January_Stops.csv'
+        as '2024-01'
+    """
+    months = {m.lower(): i for i, m in enumerate(calendar.month_name) if m}
+    found = re.search(r'(\d{4})_([A-Za-z]+)', os.path.basename(csvfile))
+    if not found or found.group(2).lower() not in months:
+        raise ValueError(f'Could not find the month of {csvfile}, '
+                         f'pass it as month')
+    return f'{found.group(1)}-{months[found.group(2).lower()]:02d}'
+
+def ingest_ridership(csvfile, dataset, month = None, append = True):
+    """
+    Converts the APC export 'csvfile' into a parquet dataset in folder
+        'dataset', partitioned by month and service type
+
+    month is a label like '2024-01' and defaults to the one in the name of
+        csvfile (see month_from_filename)
+
+    With append the partitions of other months are kept and those of this
+        month are replaced, so a month can be ingested again. Otherwise the
+        whole dataset is rewritten
+
+    Rows are sorted by line and direction so reads filtered on them skip
+        the rest of the data (see read_ridership)
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    month = month or month_from_filename(csvfile)
+    log.info(f'Ingesting {csvfile} as month {month}')
+    df = pd.read_csv(csvfile, dtype={'LineAbbr': str, 'Service': str})
+    df = normalize_ridership(df)
+    df['month'] = month
+    df = df.sort_values(['Service', 'LineAbbr', 'Direction', 'Sequence'],
+                        kind='stable')
+
+    if not append and os.path.exists(dataset):
+        shutil.rmtree(dataset)
+    ds.write_dataset(
+        pa.Table.from_pandas(df, preserve_index=False), dataset,
+        format='parquet', partitioning=ridership_partitioning(),
+        basename_template=f'{month}-{{i}}.parquet',
+        existing_data_behavior='delete_matching',
+        max_rows_per_group=4096, min_rows_per_group=1024)
+
+def read_ridership(dataset, route_num = None, dir = None, stype = None,
+                   months = None, columns = None):
+    """
+    Reads the ridership of a dataset made by ingest_ridership
+
+    route_num, dir, stype and months filter the rows as they are read: only
+        the partitions of months & service type stype are opened, and only
+        the row groups that can hold route_num and dir are read
+
+    columns defaults to all of them, including month
+    """
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(dataset, format='parquet',
+                         partitioning=ridership_partitioning())
+    filters = []
+    if route_num is not None:
+        filters.append(ds.field('LineAbbr') == str(route_num))
+    if dir is not None:
+        filters.append(ds.field('Direction') == str(dir))
+    if stype is not None:
+        filters.append(ds.field('Service') == stype)
+    if months is not None:
+        filters.append(ds.field('month').isin(list(months)))
+
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+class RidershipDataset(RidershipStore):
+    """
+    RidershipStore over one month of a dataset made by ingest_ridership
+
+    Nothing is read up front. The rows of a route are read with
+        read_ridership, filtered on line, direction, service type and month,
+        so only the partitions and row groups that hold them are opened.
+        The whole month is only read for network-wide functions that use
+        .data, and then kept.
+
+    month defaults to the only month of the dataset. With stype, the store
+        only holds that service type, as if the others weren't ingested
+    """
+    def __init__(self, dataset, month = None, stype = None):
+        self.dataset = dataset
+        self.month = month or dataset_month(dataset)
+        self.stype = stype
+        self.csvfile = f'{dataset} ({self.month})'
+        self._data = None
+        self._aggregates = {}
+
+        import pyarrow.dataset as ds
+        names = ds.dataset(dataset, format='parquet',
+                           partitioning=ridership_partitioning()).schema.names
+        self._columns = RIDER_COLUMNS + [c for c in RIDER_LOCATION_COLUMNS
+                                         if c in names]
+
+    @property
+    def data(self):
+        if self._data is None:
+            log.info(f'Loading ridership from {self.csvfile}')
+            self._data = self._read(stype=self.stype)
+        return self._data
+
+    def _read(self, route_num = None, dir = None, stype = None):
+        df = read_ridership(self.dataset, route_num, dir, stype,
+                            months=[self.month], columns=self._columns)
+        return normalize_ridership(df)
+
+    def get_rows(self, route_num, dir, stype = None):
+        """
+        Returns the ridership rows of route 'route_num' in direction 'dir'
+            and optionally service type 'stype', read from the dataset
+
+        Raises a ValueError like RidershipStore.get_rows if there are none
+        """
+        if self.stype is not None and stype not in (None, self.stype):
+            raise ValueError(f'Value {stype} was not found '
+                             f'in column Service of the dataframe')
+        df = self._read(route_num, dir, stype or self.stype)
+        if df.empty:
+            raise ValueError(f'No ridership for route {route_num} '
+                             f'direction {dir} in {self.csvfile}')
+        return df
+
+def dataset_month(dataset):
+    """
+    Returns the month of a dataset made by ingest_ridership, which must
+        hold a single one
+    """
+    months = sorted(d.split('=', 1)[1] for d in os.listdir(dataset)
+                    if d.startswith('month='))
+    if len(months) != 1:
+        raise ValueError(f'{dataset} holds the months {months}, '
+                         f'pass one of them as month')
+    return months[0]
+
+def ridership_mtime(path):
+    """
+    Returns the modification time of a ridership file, or the latest one of
+        the files and folders of a dataset
+    """
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    return max([os.path.getmtime(path)] + [
+        os.path.getmtime(os.path.join(root, name))
+        for root, dirs, files in os.walk(path) for name in dirs + files])
+
+_STORES = {}
+
+def get_ridership_store(csvfile, month = None):
+    """
+    Returns the RidershipStore of 'csvfile', only reading the file the first
+        time (or again if it changed on disk)
+
+    'csvfile' can also be the folder of a dataset made by ingest_ridership,
+        which gives a RidershipDataset of month (see RidershipDataset for
+        its default)
+
+    A RidershipStore is returned as is
+    """
+    if isinstance(csvfile, RidershipStore):
+        return csvfile
+    if not (isinstance(csvfile, str) and os.path.exists(csvfile)):
+        return RidershipStore(csvfile)
+
+    key = (os.path.abspath(csvfile), month)
+    mtime = ridership_mtime(key[0])
+    if key not in _STORES or _STORES[key][0] != mtime:
+        if os.path.isdir(csvfile):
+            store = RidershipDataset(csvfile, month)
+        else:
+            store = RidershipStore(csvfile)
+        _STORES[key] = (mtime, store)
+    return _STORES[key][1]
 
 def agg_rider_data(csvfile, route_num, dir, stype = None):
     """
@@ -83,29 +524,14 @@ def agg_rider_data(csvfile, route_num, dir, stype = None):
         and optionally service type 'stype' (like "Weekday") 
     
     Afterwards, aggregates by sum all trips to the same stop
+
+    'csvfile' can be a path or a RidershipStore. Paths are loaded into a
+        store the first time they are used (see get_ridership_store). For a
+        dataset folder only the rows of the route are read
     """
-    df = pd.read_csv(csvfile)
-    df = df[['LineAbbr', 'Direction', 'Service', 'StopId', 'AverageOn', 
-             'AverageOff', 'Sequence', 'AverageLoad', 'StopName']]
-    #return df
     if stype:
         log.info(f'Filtering ridership by service type {stype}')
-        df = pd_checkfilter(df, 'Service', stype)
-    
-    df['LineAbbr'] = df['LineAbbr'].astype(str)
-    df = pd_checkfilter(df, 'LineAbbr', str(route_num))
-    
-    df['Direction'] = df['Direction'].astype(str)
-    df = pd_checkfilter(df, 'Direction', str(dir))
-
-    df = df.groupby(['StopId']).agg({'AverageOn':'sum', 
-                                      'AverageOff':'sum', 
-                                      'AverageLoad':'sum',
-                                      'Sequence':'max',
-                                      'StopName':'max'})
-
-    #df = df[['AverageOn', 'AverageOff', 'AverageLoad']]
-    return df
+    return get_ridership_store(csvfile).aggregate(route_num, dir, stype)
 
 def create_eol_row(df):
     """
@@ -261,13 +687,10 @@ def get_ntrips(feed, route_id, dir):
         going in the same direction
     
     """
-    freq = feed.lines_freq
-    #route_id = route_id_from_route_num(feed, route)
-    freq = pd_filter(freq, 'route_id', route_id)
-    freq = pd_filter(freq, 'direction_id', dir)
-    log.info(f'the following is the number of filtered trips')
-    print(freq)
-    return sum(freq['ntrips'])
+    freq = get_route_index(feed).get('lines_freq', route_id, dir)
+    ntrips = sum(freq['ntrips'])
+    log.info(f'the number of filtered trips is {ntrips}')
+    return ntrips
 
 
 def get_segment_productivity(route_df, ntrips):
@@ -318,7 +741,7 @@ def bin_stops(df, edges):
     
     This function created with some help by a large pile of linear algebra
     """
-    edges.append(len(df)+1)
+    edges = list(edges) + [len(df)+1]
     #df['geometry'] = geopd.GeoSeries.from_wkt(df['geometry'])
     #print(type(df['geometry'][1]))
     gdf = geopd.GeoDataFrame(df, geometry='geometry')
@@ -333,6 +756,38 @@ def bin_stops(df, edges):
     agg_df = aggregate_stops(gdf)
     return agg_df
 
+def join_segment_lines(geometry, groups):
+    """
+    Joins the stop-to-stop LineStrings of each group into a single
+        LineString, concatenating their coordinates in stop order
+
+    Consecutive segments already touch end to end, so there's no need
+        for a geometric union. Repeated points where they meet are dropped.
+
+    Returns a GeoSeries indexed by the sorted groups. Groups with no
+        coordinates (e.g. just the EOL) get an empty LineString
+    """
+    codes, unique_groups = pd.factorize(groups, sort=True)
+    coords, rows = shapely.get_coordinates(
+        np.asarray(geometry), return_index=True)
+    coord_codes = codes[rows]
+
+    # Drops coordinates from other groups and repeated points
+    keep = coord_codes >= 0
+    keep[1:] &= ~((coord_codes[1:] == coord_codes[:-1]) &
+                  (coords[1:] == coords[:-1]).all(axis=1))
+    coords, coord_codes = coords[keep], coord_codes[keep]
+
+    lines = np.array([shapely.LineString()] * len(unique_groups))
+    n_coords = np.bincount(coord_codes, minlength=len(unique_groups))
+    has_line = n_coords >= 2
+    if has_line.any():
+        valid = has_line[coord_codes]
+        lines[has_line] = shapely.linestrings(
+            coords[valid],
+            indices=np.cumsum(has_line)[coord_codes[valid]] - 1)
+    return geopd.GeoSeries(lines, index=unique_groups)
+
 def aggregate_stops(grouped_df):
     """
     Helper to bin_stops; Aggregates a grouped set of stops sensibly
@@ -343,11 +798,10 @@ def aggregate_stops(grouped_df):
         segment_name is First / Last
         Distances, AverageOn and AverageOff are sums
         AverageLoad is Average
+        geometry is the LineString of its segments, joined in stop order
     """
     #print(type(grouped_df))
-    agg_df = grouped_df.dissolve(
-        by = 'groups',
-        aggfunc = {
+    agg_df = pd.DataFrame(grouped_df).groupby('groups').agg({
             'runtime_sec':'sum',
             'start_stop_name':'first',
             'end_stop_name':'last',
@@ -357,10 +811,14 @@ def aggregate_stops(grouped_df):
             'AverageOff':'sum',
             'AverageLoad':'median', # Not sure if this is the 'correct' 
                                     # way to aggregate
-            #'geometry':'union',
             'distance_mi':'sum'
-        }
-    )
+        })
+    geometry = join_segment_lines(grouped_df.geometry.values,
+                                  grouped_df['groups'].values)
+    agg_df = geopd.GeoDataFrame(
+        agg_df, geometry=geometry.reindex(agg_df.index).values,
+        crs=grouped_df.crs)
+    agg_df = agg_df[['geometry'] + list(agg_df.columns.drop('geometry'))]
     agg_df['segment_name'] = (
         agg_df['start_stop_name'] + "/" + agg_df['end_stop_name'])
     #agg_df.to_clipboard()
@@ -416,9 +874,7 @@ def get_aggregate_productivity(
     assert len(feed.time_windows) == 2
     route_id = route_id_from_route_num(feed, route_num)
     ntrips = get_ntrips(feed, route_id, dir)
-    segments_df = get_route_speed_segments(feed, route_id)
-    #print(type(segments_df))
-    segments_df = pd_filter(segments_df, 'direction_id', dir)
+    segments_df = get_route_speed_segments(feed, route_id, dir)
     debug_dataframe(segments_df)
     rider_df = agg_rider_data(csvfile, route_num, dir, stype)
     debug_dataframe(rider_df)
@@ -431,6 +887,348 @@ def get_aggregate_productivity(
     productivity_df = get_segment_productivity(combined_df, ntrips)
     return productivity_df
 
+SEGMENT_DROP_COLUMNS = ['Sequence', 'segment_id', 'shape_id', 'window',
+                        'segment_max_speed_kmh', 'avg_route_speed_kmh',
+                        'speed_kmh']
+
+def create_eol_rows(segments, keys):
+    """
+    Vectorized create_eol_row: one EOL row per group of 'keys' in
+        'segments', which must be sorted by keys and stop_sequence
+    """
+    final_rows = segments.groupby(keys, sort=False).tail(1).copy()
+    final_rows['stop_sequence'] += 1
+    final_rows['segment_name'] = 'EOL'
+    final_rows['start_stop_id'] = final_rows['end_stop_id']
+    final_rows['end_stop_id'] = 0
+    final_rows['start_stop_name'] = final_rows['end_stop_name']
+    final_rows['end_stop_name'] = 'EOL'
+    final_rows['speed_kmh'] = 0
+    final_rows['distance_m'] = 0
+    final_rows['geometry'] = shapely.LineString()
+    final_rows['shape_id'] = ''
+    final_rows['runtime_sec'] = 0
+    return final_rows
+
+def get_network_segments(feed):
+    """
+    Returns the speed segments of every route and direction of 'feed' with
+        their route number, direction as a string, number of trips and an
+        EOL row each, sorted by route, direction and stop_sequence
+
+    Route numbers shared by several route IDs are left out (logged), as
+        route_id_from_route_num would refuse them
+    """
+    routes = feed.routes[['route_id', 'route_short_name']].astype(str)
+    shared = routes['route_short_name'].duplicated(keep=False)
+    if shared.any():
+        log.info(f'Skipping route numbers with multiple route IDs: '
+                 f'{sorted(set(routes[shared].route_short_name))}')
+        routes = routes[~shared]
+    routes = routes.rename(columns={'route_short_name': 'route_num'})
+
+    segments = feed.avg_speeds.merge(routes, on='route_id')
+    segments['direction'] = segments['direction_id'].astype(int).astype(str)
+    keys = ['route_num', 'direction']
+    segments = segments.sort_values(keys + ['stop_sequence'], kind='stable')
+    segments = pd.concat([segments, create_eol_rows(segments, keys)])
+    segments = segments.sort_values(keys + ['stop_sequence'], kind='stable')
+
+    ntrips = feed.lines_freq.groupby(
+        ['route_id', feed.lines_freq['direction_id'].astype(int).astype(str)]
+        )['ntrips'].sum().rename_axis(['route_id', 'direction']).reset_index()
+    segments = segments.merge(ntrips, how='left', on=['route_id', 'direction'])
+    segments['ntrips'] = segments['ntrips'].fillna(0)
+    segments['start_stop_id'] = segments['start_stop_id'].astype(int)
+    return segments
+
+def combine_ridership_network(segments, rider_df, by = None):
+    """
+    combine_ridership_route for every route and direction in one merge
+
+    'segments' comes from get_network_segments and 'rider_df' has the
+        ridership summed by LineAbbr, Direction and StopId. 'by' lists
+        extra key columns of both, such as the period of
+        get_period_productivity, that lead the keys and the index
+
+    Returns the combined dataframe and the unmatched ridership rows of the
+        routes in 'segments'
+    """
+    by = list(by or [])
+    route_keys = by + ['route_num', 'direction']
+    keys = route_keys + ['start_stop_id']
+    rider_df = rider_df.rename(columns={'LineAbbr': 'route_num',
+                                        'Direction': 'direction',
+                                        'StopId': 'start_stop_id'})
+    df = segments.merge(rider_df, how='outer', on=keys, indicator=True,
+                        sort=False)
+
+    unmatched = df[df._merge == 'right_only']
+    served = unmatched.set_index(route_keys).index.isin(
+        segments.set_index(route_keys).index.unique())
+    unmatched = unmatched.loc[served, keys + ['StopName', 'AverageOn',
+                                              'AverageOff', 'Sequence']]
+    if not unmatched.empty:
+        log.info(f'the following stops were unmatched \n'
+                 f'{unmatched}\n')
+
+    df = df[df._merge != 'right_only'].drop(['_merge'], axis=1)
+    df = df.sort_values(route_keys + ['stop_sequence'], kind='stable')
+    df['stop_sequence'] = df['stop_sequence'].astype(int) - 1
+    df = df.set_index(by + ['route_num', 'direction_id', 'stop_sequence'])
+    df = df.drop(SEGMENT_DROP_COLUMNS + ['start_stop_id'], axis=1)
+    df['distance_mi'] = df['distance_m'] / 1609
+    return geopd.GeoDataFrame(df, geometry='geometry',
+                              crs=segments.crs), unmatched
+
+def sum_network_ridership(rows, stype = None, by = None):
+    """
+    Sums ridership rows by LineAbbr, Direction and StopId (and the extra
+        keys in 'by') as agg_rider_data does for a single route
+    """
+    if stype:
+        log.info(f'Filtering ridership by service type {stype}')
+        rows = pd_checkfilter(rows, 'Service', stype)
+    return rows.groupby(list(by or []) + ['LineAbbr', 'Direction', 'StopId'],
+                        observed=True).agg(RIDER_AGGREGATION).reset_index()
+
+def get_network_productivity(feed, csvfile, stype = 'Weekday',
+                             match_distance = None, stop_inventory = None):
+    """
+    get_aggregate_productivity for every route and direction of 'feed' at
+        once, without edges
+
+    All the speed segments are joined with all the ridership in a single
+        keyed merge, and productivity is computed on the whole table.
+
+    Returns a dataframe indexed by route number, direction_id and
+        stop_sequence, so that .loc[(route_num, dir)] has the rows that
+        get_aggregate_productivity returns for that route. Ridership that
+        can't be matched to a stop of its route is logged and left out, as
+        with retry_matching=False in combine_ridership_route
+
+    With match_distance (meters), unmatched ridership is instead moved to
+        the nearest stop of its route within that distance, located by
+        the Latitude and Longitude of the ridership file or of
+        stop_inventory (see ridership_stop_locations). The audit table of
+        match_stops_by_location is kept in .attrs['stop_matches']
+    """
+    assert len(feed.time_windows) == 2
+    segments = get_network_segments(feed)
+
+    store = get_ridership_store(csvfile)
+    rider_df = sum_network_ridership(store.data, stype)
+
+    df, unmatched = combine_ridership_network(segments, rider_df)
+    audit = None
+    if match_distance and not unmatched.empty:
+        audit = match_stops_by_location(
+            feed, segments, unmatched,
+            ridership_stop_locations(store, stop_inventory), match_distance)
+        rider_df = move_ridership_stops(rider_df, audit)
+        df, unmatched = combine_ridership_network(segments, rider_df)
+
+    ntrips = df.pop('ntrips')
+    df = df.drop(['route_id', 'route_name', 'direction'], axis=1)
+    df = get_segment_productivity(df, ntrips.values)
+    if audit is not None:
+        df.attrs['stop_matches'] = audit
+    return df
+
+def ridership_stop_locations(csvfile, stop_inventory = None):
+    """
+    Returns the Latitude and Longitude of each StopId of the ridership
+
+    They come from stop_inventory if given (a dataframe with StopId,
+        Latitude and Longitude), or else from the ridership file itself
+
+    Raises a ValueError if neither has them
+    """
+    if stop_inventory is None:
+        stop_inventory = get_ridership_store(csvfile).data
+    missing = [c for c in ['StopId'] + RIDER_LOCATION_COLUMNS
+               if c not in stop_inventory.columns]
+    if missing:
+        raise ValueError(f'Stop locations need the columns {missing}, '
+                         f'pass a stop_inventory that has them')
+
+    locations = stop_inventory[['StopId'] + RIDER_LOCATION_COLUMNS].dropna()
+    locations = locations.astype({'StopId': int})
+    return locations.groupby('StopId').first()
+
+def match_stops_by_location(feed, segments, unmatched, locations,
+                            max_distance = 100, k = 8):
+    """
+    Matches unmatched ridership stops to the nearest stop of their route
+
+    'segments' and 'unmatched' come from get_network_segments and
+        combine_ridership_network and 'locations' from
+        ridership_stop_locations
+
+    All the unmatched stops are looked up in one query of a KD-tree over
+        the stops of 'feed', taking the k nearest within max_distance
+        meters. The nearest of them served by the same route and direction
+        is the match
+
+    Returns an audit table with a row per unmatched stop: the stop_id,
+        stop_name and distance_m of the match, and a status of 'matched',
+        'no location', 'too far' (no stop within max_distance) or
+        'not on route' (none of the stops found is served by the route)
+    """
+    log.info(f'Matching {len(unmatched)} ridership stops by location')
+    audit = unmatched[['route_num', 'direction', 'start_stop_id', 'StopName',
+                       'AverageOn', 'AverageOff']].rename(
+        columns={'start_stop_id': 'StopId'}).reset_index(drop=True)
+    coords = locations.reindex(audit['StopId'])
+
+    stops = feed.projected_stops
+    stop_xy = np.column_stack([stops.geometry.x.values,
+                               stops.geometry.y.values])
+    has_xy = ~np.isnan(stop_xy).any(axis=1)
+    feed_stop_ids = stops['stop_id'].values[has_xy]
+    stop_ids = pd.to_numeric(feed_stop_ids, errors='coerce')
+    stop_names = stops['stop_name'].values[has_xy]
+
+    located = coords.notnull().all(axis=1).values
+    x, y = feed.transformer.transform(coords['Longitude'].values[located],
+                                      coords['Latitude'].values[located])
+    k = min(k, len(stop_ids))
+    distances, nearest = cKDTree(stop_xy[has_xy]).query(
+        np.column_stack([x, y]), k=k, distance_upper_bound=max_distance)
+    distances = distances.reshape(len(x), k)
+    nearest = nearest.reshape(len(x), k)
+
+    # Candidates within the distance that are stops of the same route
+    found = np.isfinite(distances)
+    candidate_ids = np.where(found, stop_ids[np.minimum(nearest,
+                                                        len(stop_ids) - 1)],
+                             np.nan)
+    route_stops = segments.set_index(
+        ['route_num', 'direction', 'start_stop_id']).index.unique()
+    candidates = pd.MultiIndex.from_arrays([
+        np.repeat(audit['route_num'].values[located], k),
+        np.repeat(audit['direction'].values[located], k),
+        candidate_ids.ravel()])
+    on_route = found & candidates.isin(route_stops).reshape(-1, k)
+    best = on_route.argmax(axis=1)
+    matched = on_route.any(axis=1)
+    rows = np.arange(len(best))
+    best_stop = np.minimum(nearest[rows, best], len(stop_ids) - 1)
+
+    status = np.where(matched, 'matched',
+                      np.where(found.any(axis=1), 'not on route', 'too far'))
+    audit['status'] = 'no location'
+    audit.loc[located, 'status'] = status
+    # The matched stop_id as in the feed (a string), to join back to it
+    audit['stop_id'] = None
+    audit.loc[located, 'stop_id'] = np.where(
+        matched, feed_stop_ids[best_stop], None)
+    audit['stop_name'] = None
+    audit.loc[located, 'stop_name'] = np.where(
+        matched, stop_names[best_stop], None)
+    audit['distance_m'] = np.nan
+    audit.loc[located, 'distance_m'] = np.where(
+        matched, distances[rows, best], np.nan)
+
+    log.info(f'Stop matching results:\n{audit.status.value_counts()}\n')
+    return audit
+
+def move_ridership_stops(rider_df, audit):
+    """
+    Moves the ridership of the stops matched in 'audit' (from
+        match_stops_by_location) onto their matched stop_id, summing it
+        with any ridership the stop already had
+    """
+    moves = pd.to_numeric(audit[audit.status == 'matched'].set_index(
+        ['route_num', 'direction', 'StopId'])['stop_id'])
+    keys = pd.MultiIndex.from_frame(
+        rider_df[['LineAbbr', 'Direction', 'StopId']],
+        names=moves.index.names)
+    new_ids = moves.reindex(keys).values
+
+    rider_df = rider_df.copy()
+    rider_df['StopId'] = np.where(np.isnan(new_ids), rider_df['StopId'],
+                                  new_ids).astype(int)
+    return rider_df.groupby(['LineAbbr', 'Direction', 'StopId']).agg(
+        RIDER_AGGREGATION).reset_index()
+
+PERIOD_METRICS = ['AverageOn', 'AverageOff', 'AverageLoad', 'avg_activity',
+                  'runtime_sec', 'speed', 'vehicle_hours', 'productivity_on',
+                  'productivity_activity', 'productivity_load']
+
+def get_period_productivity(periods, stype = 'Weekday'):
+    """
+    get_network_productivity for several periods in one pass
+
+    'periods' maps a label (e.g. '2024-01') to a (ridership, feed) pair,
+        in the order the periods should be compared. Ridership is a csv
+        file, a dataset folder or a RidershipStore (e.g. from
+        RidershipStore.from_dataset).
+        Each feed follows the rules of get_aggregate_productivity
+
+    Segments are built once per distinct feed, so periods sharing a feed
+        snapshot share its segment geometry. All periods are then merged
+        with their ridership and given productivity in a single pass
+
+    Returns a long dataframe indexed by period, route number, direction_id
+        and stop_sequence, with a '<column>_delta' for each of
+        PERIOD_METRICS: the change from the previous period for the
+        segment starting at the same stop, NaN if it had no such segment
+    """
+    labels = list(periods)
+    period_type = pd.CategoricalDtype(labels, ordered=True)
+
+    feed_segments = {}
+    segments, rows = [], []
+    for label, (ridership, feed) in periods.items():
+        assert len(feed.time_windows) == 2
+        if id(feed) not in feed_segments:
+            log.info(f'Building network segments for period {label}')
+            feed_segments[id(feed)] = get_network_segments(feed)
+        segments.append(feed_segments[id(feed)].assign(period=label))
+
+        if not isinstance(ridership, RidershipStore):
+            ridership = get_ridership_store(ridership)
+        rows.append(ridership.data.assign(period=label))
+
+    segments = pd.concat(segments, ignore_index=True)
+    segments['period'] = segments['period'].astype(period_type)
+    segments['segment_stop_id'] = segments['start_stop_id']
+    rows = pd.concat(rows, ignore_index=True)
+    rows['period'] = rows['period'].astype(period_type)
+
+    rider_df = sum_network_ridership(rows, stype, by=['period'])
+    df, unmatched = combine_ridership_network(segments, rider_df,
+                                              by=['period'])
+    ntrips = df.pop('ntrips')
+    df = df.drop(['route_id', 'route_name', 'direction'], axis=1)
+    df = get_segment_productivity(df, ntrips.values)
+    return add_period_deltas(df)
+
+def add_period_deltas(df):
+    """
+    Helper to get_period_productivity; adds the change of each of
+        PERIOD_METRICS from the previous period of the same segment
+
+    Segments are matched on route number, direction_id and the stop they
+        start at (counted in order, for routes that visit a stop twice)
+    """
+    df = df.reset_index()
+    keys = ['route_num', 'direction_id', 'segment_stop_id', 'visit']
+    df['visit'] = df.groupby(['period'] + keys[:-1], observed=True).cumcount()
+    df['period_rank'] = df['period'].cat.codes
+
+    previous = df[keys + ['period_rank'] + PERIOD_METRICS].copy()
+    previous['period_rank'] += 1
+    previous = df[keys + ['period_rank']].merge(
+        previous, how='left', on=keys + ['period_rank'])
+    for col in PERIOD_METRICS:
+        df[col + '_delta'] = df[col].values - previous[col].values
+
+    df = df.drop(['visit', 'period_rank'], axis=1)
+    return df.set_index(['period', 'route_num', 'direction_id',
+                         'stop_sequence'])
+
 def debug_dataframe(df):
     global DEBUG_STEP
     if DEBUG_MODE:
@@ -6,6 +6,9 @@ Author: Lilah Rosenfield || Utah Transit Authority
 11925@rideuta.com
 """
 
+import os
+import weakref
+from collections import OrderedDict
 import pandas as pd
 import geopandas as geopd
 # import shapely
@@ -14,6 +17,7 @@ import logging as log
 # import jenkspy
 import numpy as np
 import folium
+from concurrent.futures import ProcessPoolExecutor
 from branca.colormap import LinearColormap
 import ridership_functions as rfx
 import gtfs_functions
@@ -72,20 +76,48 @@ def plot_2(gdf,
     Returns a layer with name name for a folium map highlighting a given column 
         from a provided GeoDataFrame
     """
-    tooltip_var = ['start_stop_name','AverageOn','AverageOff','speed','productivity_activity', 'seq']
-    tooltip_labels = ['Segment Start: ','Boardings: ', 'Alightings: ', 'Speed (mph): ', 'Productivity: ', 'Stop Sequence']
-
-    gdf['fill_color'] = gdf[highlight].apply(lambda x: colorscale(x))
+    return geojson_layer(
+        color_layer(layer_data(gdf), colorscale, highlight), name)
 
+def layer_data(gdf):
+    """
+    Returns the rows of gdf as GeoJSON-like data for color_layer
+        and geojson_layer
+    """
     gdf['seq'] = gdf.index
 
+    return gdf.__geo_interface__
+
+def color_layer(geo_data, colorscale=DEFAULT_COLORSCALE,
+                highlight = 'productivity_activity'):
+    """
+    Returns a copy of geo_data from layer_data with its features coloured by
+        property highlight
+
+    geo_data itself is left as is, so it can be coloured again by another
+        property. Geometries are shared with the copy
+    """
+    features = []
+    for feature in geo_data['features']:
+        properties = dict(feature['properties'])
+        properties['fill_color'] = colorscale(properties[highlight])
+        features.append(dict(feature, properties=properties))
+
+    return dict(geo_data, features=features)
+
+def geojson_layer(geo_data, name):
+    """
+    Returns a folium layer with name name for data from color_layer
+    """
+    tooltip_var = ['start_stop_name','AverageOn','AverageOff','speed','productivity_activity', 'seq']
+    tooltip_labels = ['Segment Start: ','Boardings: ', 'Alightings: ', 'Speed (mph): ', 'Productivity: ', 'Stop Sequence']
+
     def style_function(feature):
         return {
             'fillOpacity': 0.5,
             'weight': 6,  # math.log2(feature['properties']['speed'])*2,
             'color': feature['properties']['fill_color']}
     # my code for lines
-    geo_data = gdf.__geo_interface__
     lyr = folium.GeoJson(
         geo_data,
         style_function=style_function,
@@ -99,9 +131,6 @@ def plot_2(gdf,
         )
     
     return lyr
-    #colorscale.caption = 'Productivity Legend'
-
-    # return m
 
 def initialized_map(feed, lyrs, colorscale = DEFAULT_COLORSCALE):
     """
@@ -143,17 +172,114 @@ def build_lyr_for_route(feed: gtfs_functions.Feed, route, edges:list,
     Passes highlight (str) and colorscale to ridership_plots.plot_2
     """
 
-    name = "Route " + str(route) + " Direction " + str(direction)
+    name = route_layer_name(route, direction)
         #try:
     log.info(f'Building layer for {name} with highlight {highlight}')
+    geo_data = route_layer_data(feed, route, edges, direction, csv)
+    
+    log.info('Getting Layer')
+    return geojson_layer(color_layer(geo_data, colorscale, highlight), name)
+
+def route_layer_name(route, direction):
+    return "Route " + str(route) + " Direction " + str(direction)
+
+def route_layer_data(feed, route, edges, direction, csv):
+    """
+    Aggregates the productivity of route & direction over edges (see
+        ridership_functions.get_aggregate_productivity) and returns it as
+        layer_data, ready for color_layer
+    """
     gdf = rfx.get_aggregate_productivity(
         feed, csv, route, direction, edges
                     )
     gdf = gdf.fillna(0)
-    
-    log.info('Getting Layer')
-    lyr = plot_2(gdf, name, colorscale=colorscale, highlight=highlight)
-    return lyr
+    return layer_data(gdf)
+
+_TRIP_HASHES = weakref.WeakKeyDictionary()
+
+def feed_fingerprint(feed):
+    """
+    Returns a hashable fingerprint of feed: its path, service_ids and
+        time_windows, and a hash of its trip IDs so that a newer feed at
+        the same path doesn't match
+
+    Only the trip hash is kept per feed. The rest is read on every call,
+        so changing feed.time_windows gives a new fingerprint
+    """
+    if feed not in _TRIP_HASHES:
+        _TRIP_HASHES[feed] = int(pd.util.hash_pandas_object(
+            feed.trips['trip_id'], index=False).sum())
+    return (str(feed.gtfs_path), tuple(feed.service_ids or ()),
+            tuple(feed.time_windows), _TRIP_HASHES[feed])
+
+def ridership_state(csv):
+    """
+    Returns a hashable state of the ridership csv (or dataset): its path and
+        modification time, so layers aren't reused after the file changes (as
+        ridership_functions.get_ridership_store reloads it). A
+        RidershipStore is its own state
+    """
+    if isinstance(csv, rfx.RidershipStore):
+        return csv
+    if isinstance(csv, str) and os.path.exists(csv):
+        path = os.path.abspath(csv)
+        return (path, rfx.ridership_mtime(path))
+    return str(csv)
+
+class LayerCache:
+    """
+    Bounded LRU cache of route layers, for the productivity monitor
+
+    Layers are keyed by (feed fingerprint, ridership_state(csv), route,
+        direction, edges, highlight). The aggregated data behind them is cached separately,
+        without highlight, so switching highlight only recolours: no
+        ridership is read, aggregated, binned or serialized again.
+
+    Each level keeps at most maxsize entries, dropping the least recently
+        used. The colorscale is assumed to be the same for every layer
+    """
+    def __init__(self, maxsize = 32, colorscale = DEFAULT_COLORSCALE):
+        self.maxsize = maxsize
+        self.colorscale = colorscale
+        self._data = OrderedDict()
+        self._layers = OrderedDict()
+
+    def _lookup(self, cache, key, build):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = build()
+        cache[key] = value
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return value
+
+    def get_layer(self, feed, route, edges, direction, csv, highlight):
+        """
+        Returns the layer build_lyr_for_route would, from cache if possible
+        """
+        data_key = (feed_fingerprint(feed), ridership_state(csv), str(route),
+                    str(direction), tuple(edges or ()))
+
+        def build_data():
+            log.info(f'Preparing layer data for route {route} '
+                     f'direction {direction}')
+            return route_layer_data(feed, route, edges, direction, csv)
+
+        def build_layer():
+            geo_data = self._lookup(self._data, data_key, build_data)
+            log.info(f'Colouring route {route} direction {direction} '
+                     f'by {highlight}')
+            return geojson_layer(
+                color_layer(geo_data, self.colorscale, highlight),
+                route_layer_name(route, direction))
+
+        return self._lookup(self._layers, data_key + (highlight,),
+                            build_layer)
+
+    def clear(self):
+        self._data.clear()
+        self._layers.clear()
 
 
 def build_map_for_route(feed, route, edges, direction, map_in,
@@ -180,75 +306,149 @@ def build_map_for_route(feed, route, edges, direction, map_in,
     return map_in
 
 def build_map(feed, csv = rfx.CSV_PATH,
-              step = 4, colorscale = DEFAULT_COLORSCALE):
-    #routes = [455]
-
-    routes = ['1', '17', '2', '200', '201', '205', '209', '21', '213', '217', 
-              '218', '220', '223', '227', '240', '248', '33', '35', '39', '4', 
-              '45', '451', '455', '47', '470', '509', '513', '54', 
-              '603X', '604', '612', '613', '62', '625', '626', '627', 
-              '628', '630', '640', '645', '72', '805', 
-              '806', '807', '821', '822', '830X', '831', 
-              '834', '850', '862', '871',
-              '9', 'F11', 'F202', 'F232', 'F453', 
-              'F514', 'F556', 'F570', 'F578', 'F590', 
-              'F618', 'F620', 'F94']
-
-            # Removed routes are:
-            # All Ski service
-            # 472, 473, 551 601, 602, 606, F638, 667, 833
-    #routes = list(feed.routes['route_short_name'])
+              step = 4, colorscale = DEFAULT_COLORSCALE,
+              routes = None, n_jobs = 1):
+    """
+    Builds the productivity map of every route and saves it to index.html
+
+    See build_network_map for routes and n_jobs
+    """
+    return build_network_map(feed, csv, step, colorscale,
+                             'productivity_activity', 'index.html',
+                             routes, n_jobs)
+
+def get_route_list(feed, exclude = None):
+    """
+    Returns the route numbers of the routes with speed segments in feed,
+        sorted, leaving out those in exclude (e.g. seasonal service)
 
+    Route numbers shared by several route IDs are left out, since
+        ridership_functions.route_id_from_route_num can't resolve them
+    """
+    exclude = {str(r) for r in exclude or []}
+    route_index = rfx.get_route_index(feed)
+    return sorted(
+        route_num for route_num, route_ids in route_index.route_ids.items()
+        if len(route_ids) == 1 and route_num not in exclude
+        and not route_index.get('avg_speeds', route_ids[0]).empty)
+
+def network_map(feed):
+    """
+    Returns an empty folium.Map centered on the speed segments of feed
+    """
     routegeom = geopd.GeoDataFrame(feed.avg_speeds, geometry='geometry')
     minx, miny, maxx, maxy = routegeom.geometry.total_bounds
 
     centroid_lat = miny + (maxy - miny)/2
     centroid_lon = minx + (maxx - minx)/2
 
-    m = folium.Map(
+    return folium.Map(
         location=[centroid_lat, centroid_lon],
         tiles='cartodbpositron', zoom_start=12
         )
 
-    #ldf = {}
-    directions = [1, 0]
-    for direction in directions:
-        for route in routes:
-            glen = get_number_stops(feed, route, direction)
-            name = "Route " + str(route) + " Direction " + str(direction)
-            #try:
-            log.info(f'Trying {name}')
-            gdf = bin_for_map(
-                feed, csv, route, direction, glen, step
-                    )
-            plot_2(gdf, name).add_to(m)
+# Feed and ridership of the layer workers, set once per process
+_layer_worker = {}
 
-            
-            # Handle weird annoying cases where the number of stops is???
-                # More than the number of stops (?????)
+def init_layer_worker(feed, csv):
+    """
+    Keeps the read-only feed and ridership store of a layer worker
+    """
+    _layer_worker['feed'] = feed
+    _layer_worker['csv'] = rfx.get_ridership_store(csv)
 
-            # Update: should be fixed by modifying get_number_stops to drop duplicates
+def prepare_route_layer(route, direction, step):
+    """
+    Aggregates, bins and serializes the layer of route & direction using the
+        feed and ridership of init_layer_worker. Colours are left to
+        color_layer
 
-            # except ValueError:
-            #     log.info('Route ' + str(route) + "threw an error")
-            #     glen = glen - 5
-            #     bin_for_map(
-            #         feed, csv, route, direction, glen, step
-            #         )
-            #     plot_2(gdf, colorscale, name).add_to(m)
-    
+    Returns (geo_data, None), or (None, error message) if the route fails
+    """
+    feed = _layer_worker['feed']
+    csv = _layer_worker['csv']
+    try:
+        glen = get_number_stops(feed, route, direction)
+        gdf = bin_for_map(feed, csv, route, direction, glen, step)
+        return layer_data(gdf), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+def build_network_map(feed, csv, step, colorscale, highlight, savepoint,
+                      routes = None, n_jobs = 1):
+    """
+    Builds a map with a layer per route & direction highlighting column
+        highlight, and saves it to savepoint
+
+    routes defaults to get_route_list(feed). Only the directions each route
+        has in the feed are built.
+
+    With n_jobs > 1 the layers are prepared in a pool of n_jobs processes
+        (-1 uses all cores), each one with its own copy of the feed and
+        ridership. Layers are added to the map in the same order either way.
+
+    A route that fails doesn't stop the build. Returns a report with the
+        status of every layer, and the error of those that failed
+    """
+    if routes is None:
+        routes = get_route_list(feed)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    csv = rfx.get_ridership_store(csv)
+
+    # Only the directions that each route has. Unknown routes keep both
+    # so that they show up as failed in the report
+    route_index = rfx.get_route_index(feed)
+    route_dirs = {}
+    for route in map(str, routes):
+        try:
+            route_id = route_index.route_id(route)
+            segments = route_index.get('avg_speeds', route_id)
+            route_dirs[route] = {int(d) for d in segments['direction_id']}
+        except ValueError:
+            route_dirs[route] = {1, 0}
+
+    layers = [(route, direction)
+              for direction in [1, 0]
+              for route in map(str, routes)
+              if direction in route_dirs[route]]
+    args = [(route, direction, step) for route, direction in layers]
+
+    log.info(f'Building {len(layers)} layers')
+    if n_jobs > 1 and len(layers) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=init_layer_worker,
+                                 initargs=(feed, csv)) as pool:
+            results = list(pool.map(prepare_route_layer, *zip(*args)))
+    else:
+        init_layer_worker(feed, csv)
+        results = [prepare_route_layer(*a) for a in args]
+
+    m = network_map(feed)
+    report = []
+    for (route, direction), (geo_data, error) in zip(layers, results):
+        name = "Route " + str(route) + " Direction " + str(direction)
+        if error is None:
+            geo_data = color_layer(geo_data, colorscale, highlight)
+            geojson_layer(geo_data, name).add_to(m)
+        else:
+            log.info(f'{name} failed: {error}')
+        report.append({'route': route, 'direction': direction,
+                       'status': 'failed' if error else 'ok',
+                       'error': error})
 
     colorscale.add_to(m)
     
     folium.LayerControl().add_to(m)
 
-    m.save('index.html')
+    m.save(savepoint)
+    return pd.DataFrame(report,
+                        columns=['route', 'direction', 'status', 'error'])
 
 def get_number_stops(feed, route_num, direction):
     gd_route = rfx.get_route_speed_segments(
-        feed, rfx.route_id_from_route_num(feed, route_num)
+        feed, rfx.route_id_from_route_num(feed, route_num), direction
         )
-    gd_route = rfx.pd_filter(gd_route, 'direction_id', direction)
     log.info(f'Number of stops (preliminary) {len(gd_route)}')
     gd_route = gd_route.drop_duplicates(subset = ['stop_sequence'])
     rtn = len(gd_route)
@@ -267,44 +467,13 @@ def bin_for_map(feed, csv, route, direction, length, step):
     #ldf[route] = gdf
     return gdf
 
-def build_map_for_speed(feed, csv = rfx.CSV_PATH, step = 5):
+def build_map_for_speed(feed, csv = rfx.CSV_PATH, step = 5,
+                        routes = None, n_jobs = 1):
     """
-    I Know, I Know,
+    Builds the speed map of every route and saves it to speed.html
 
-    At some point I'll actually refactor
-    
-    But for now...
+    See build_network_map for routes and n_jobs
     """
-
-    #routes = [455]
-
-    routes = ['1', '17', '2', '200', '201', '205', '209', '21', '213', '217', 
-              '218', '220', '223', '227', '240', '248', '33', '35', '39', '4', 
-              '45', '451', '455', '47', '470', '509', '513', '54', 
-              '603X', '604', '612', '613', '62', '625', '626', '627', 
-              '628', '630', '640', '645', '72', '805', 
-              '806', '807', '821', '822', '830X', '831', 
-              '834', '850', '862', '871',
-              '9', 'F11', 'F202', 'F232', 'F453', 
-              'F514', 'F556', 'F570', 'F578', 'F590', 
-              'F618', 'F620', 'F94']
-
-            # Removed routes are:
-            # All Ski service
-            # 472, 473, 551 601, 602, 606, F638, 667, 833
-    #routes = list(feed.routes['route_short_name'])
-
-    routegeom = geopd.GeoDataFrame(feed.avg_speeds, geometry='geometry')
-    minx, miny, maxx, maxy = routegeom.geometry.total_bounds
-
-    centroid_lat = miny + (maxy - miny)/2
-    centroid_lon = minx + (maxx - minx)/2
-
-    m = folium.Map(
-        location=[centroid_lat, centroid_lon],
-        tiles='cartodbpositron', zoom_start=12
-        )
-
     colorscale = LinearColormap(
         colors=['#570600', '#ce0e2d', '#dc7237', '#f6d32a', '#6abf4b','#45842e','#2e847d'],
         index =[0, 10, 15, 20, 25, 30, 40],
@@ -314,36 +483,5 @@ def build_map_for_speed(feed, csv = rfx.CSV_PATH, step = 5):
         caption='Speed'
     )
 
-    #ldf = {}
-    directions = [1, 0]
-    for direction in directions:
-        for route in routes:
-            glen = get_number_stops(feed, route, direction)
-            name = "Route " + str(route) + " Direction " + str(direction)
-            #try:
-            log.info(f'Trying {name}')
-            gdf = bin_for_map(
-                feed, csv, route, direction, glen, step
-                    )
-            plot_2(gdf, colorscale, name, 'speed').add_to(m)
-
-            
-            # Handle weird annoying cases where the number of stops is???
-                # More than the number of stops (?????)
-
-            # Update: should be fixed by modifying get_number_stops to drop duplicates
-
-            # except ValueError:
-            #     log.info('Route ' + str(route) + "threw an error")
-            #     glen = glen - 5
-            #     bin_for_map(
-            #         feed, csv, route, direction, glen, step
-            #         )
-            #     plot_2(gdf, colorscale, name).add_to(m)
-    
-
-    colorscale.add_to(m)
-    
-    folium.LayerControl().add_to(m)
-
-    m.save('speed.html')
\ No newline at end of file
+    return build_network_map(feed, csv, step, colorscale, 'speed',
+                             'speed.html', routes, n_jobs)
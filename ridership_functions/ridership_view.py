@@ -1,3 +1,9 @@
+import multiprocessing
+# The feed is loaded in a worker process, which frozen (PyInstaller) builds
+# need to start through here
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
 from pythonnet import set_runtime
 set_runtime('netfx')
 
@@ -21,7 +27,7 @@ import json
 from ridershipViewObjects import InteractableModelItem as Item
 from ridershipViewObjects import AppClass
 # import folium
-from nicegui import run, ui, context, app, events
+from nicegui import ui, context, app, events
 import pandas
 #import gtfs_functions
 import datetime as dt
@@ -38,6 +44,7 @@ dirs = Item()
 prodToggle = Item()
 stopsTable = Item()
 buttonObject = Item()
+layerCache = rplt.LayerCache(maxsize=32)
 
 buttonObject.visibility = False
 prodToggle.valuesMap = {
@@ -100,8 +107,9 @@ def activate_button_function():
 @ui.refreshable
 def activate_map_function():
     if appObject.isFeedLoaded:
-        appObject.mapItem = rplt.initialized_map(feed=appObject.feed, 
-                                                lyrs=appObject.mapLayers)
+        with appObject.precompute.lock:
+            appObject.mapItem = rplt.initialized_map(feed=appObject.feed,
+                                                    lyrs=appObject.mapLayers)
         html = appObject.mapItem.get_root()._repr_html_()
         html = html.replace('">', 'height:100%;">',1)
         html = html.replace('height:0','height:100%',1)
@@ -114,7 +122,8 @@ def set_routes():
     """
     Sets the list of routes as the value of values in the provided GTFS Feed
     """
-    route_list = appObject.feed.routes['route_short_name'].tolist()
+    with appObject.precompute.lock:
+        route_list = appObject.feed.routes['route_short_name'].tolist()
     routes.valuesList = route_list
 
 async def start_feedload():
@@ -133,24 +142,50 @@ async def start_feedload():
         routes.visibility = True
     elif os.path.splitext(appObject.feedURI)[1] == '.zip':
         logging.info('Detected zipped feed, loading!')
-        appObject.feed = await run.cpu_bound(appObject.load_feed)
+        try:
+            feed = await appObject.precompute.loadFeed(appObject.feedURI)
+        except RuntimeError as e:
+            appObject.isFeedLoading = False
+            ui.notify(str(e), type='negative')
+            return
+        if feed is None:
+            appObject.isFeedLoading = False
+            ui.notify('Feed loading cancelled')
+            return
+        appObject.feed = feed
         appObject.needsPickling = True
         routes.visibility = True   
     
     else:
         appObject.isFeedLoading = False
         raise ValueError(f'File {appObject.feedURI} has wrong extension')
+    await start_precompute()
+
+async def start_precompute():
+    """
+    Precomputes the route lookups & ridership aggregates in the background
+        once there's a feed, so they're ready when the user picks a route
+    """
+    if appObject.isFeedLoaded:
+        await appObject.precompute.precompute(appObject.feed,
+                                              appObject.csvURI)
+
+def cancel_feedload():
+    appObject.precompute.cancel()
 
 def update_dirs():
     logging.info(f"Updating direction for route number {routes.userValue}")
     
     # Note: adds previously undefined object rid to Item 'routes'
     if routes.userValue is not None:
-        rid = rfx.route_id_from_route_num(appObject.feed, routes.userValue)
-        routes.speed_segs = rfx.pd_checkfilter(
-            appObject.feed.avg_speeds,'route_id', rid)
-        trips = rfx.pd_checkfilter(appObject.feed.trips, 'route_id', rid)
-        dirs_list = list(set(trips['direction_id']))
+        with appObject.precompute.lock:
+            route_index = rfx.get_route_index(appObject.feed)
+            rid = route_index.route_id(routes.userValue)
+            dirs_list = route_index.directions(rid)
+        routes.rid = rid
+        if not dirs_list:
+            raise ValueError(f'Value {rid} was not found '
+                             f'in column route_id of the dataframe')
         dirs.valuesList = dirs_list
     else:
         logging.info("No route provided, holding")
@@ -166,9 +201,13 @@ def update_stops():
         loads a table of stops into the stopsTable object
         refreshes the list view and the map update button
     """
-    # Filters the GTFS speed segments
-    route_in_dir = rfx.pd_checkfilter(
-        routes.speed_segs, 'direction_id', dirs.userValue)
+    # Gets the GTFS speed segments
+    with appObject.precompute.lock:
+        route_in_dir = rfx.get_route_speed_segments(
+            appObject.feed, routes.rid, dirs.userValue)
+    if route_in_dir.empty:
+        raise ValueError(f'Value {dirs.userValue} was not found '
+                         f'in column direction_id of the dataframe')
     stop_only = route_in_dir[['stop_sequence', 'start_stop_name']]
     
     # Prettifies and creates the columns
@@ -201,18 +240,13 @@ def update_map():
     buttonObject.visibility = False
     ui.notify(f'Calculating {prodToggle.userValue}')
 
-    # Setting up the edges from the checked values
-    edges = set(pandas.DataFrame(stopsTable.userValue)['id'].tolist())
-    edges = {v - 1 for v in edges}
-    edges.add(0)
-    edges_lst = list(edges)
-    edges_lst.sort()
-    
-    # Create the layer for the routes
-    newlyr = rplt.build_lyr_for_route(
-        appObject.feed, routes.userValue, edges_lst, dirs.userValue,
-        highlight=prodToggle.valuesMap[prodToggle.userValue],
-        csv=appObject.csvURI)
+    # Create the layer for the routes (cached, see rplt.LayerCache)
+    with appObject.precompute.lock:
+        newlyr = layerCache.get_layer(
+            appObject.feed, routes.userValue,
+            selected_edges(stopsTable.userValue), dirs.userValue,
+            csv=appObject.csvURI,
+            highlight=prodToggle.valuesMap[prodToggle.userValue])
     route_dir = (routes.userValue, dirs.userValue)
     
     # Places the layer and the edges into dictionaries
@@ -221,6 +255,34 @@ def update_map():
     buttonObject.userValue = "Update Segments"
     activate_map_function.refresh()
 
+def selected_edges(records):
+    """
+    Returns the sorted edges for the stops checked in the stops table
+    """
+    edges = set(pandas.DataFrame(records)['id'].tolist())
+    edges = {v - 1 for v in edges}
+    edges.add(0)
+    edges_lst = list(edges)
+    edges_lst.sort()
+    return edges_lst
+
+def update_highlight(value):
+    """
+    Switches the highlight between productivity and speed, recolouring the
+        layers already on the map from the layer cache
+    """
+    prodToggle.setUserValue(value)
+    if not appObject.mapLayers:
+        return
+    with appObject.precompute.lock:
+        for route_dir in appObject.mapLayers:
+            appObject.mapLayers[route_dir] = layerCache.get_layer(
+                appObject.feed, route_dir[0],
+                selected_edges(appObject.edgesDict[route_dir]), route_dir[1],
+                csv=appObject.csvURI,
+                highlight=prodToggle.valuesMap[value])
+    activate_map_function.refresh()
+
 def download_map():
     """
     Saves a raw Leaflet map to the folder Saved Maps with a title defined by
@@ -356,7 +418,7 @@ def application():
                         for i in prodToggle.valuesList:
                             ui.item(
                                 i, 
-                                on_click=lambda i=i: prodToggle.setUserValue(i)
+                                on_click=lambda i=i: update_highlight(i)
                                 )
                 routes_dropdown_function()
                 list_dirs_function()
@@ -398,6 +460,16 @@ with ui.row().classes('self-center'):
     pickle_button.bind_visibility_from(appObject, 'needsPickling')
     spinner = ui.spinner().classes('self-center')
     spinner.bind_visibility_from(appObject, 'isFeedLoading')
+    cancel_button = ui.button('Cancel', on_click=cancel_feedload)
+    cancel_button.classes('self-center')
+    cancel_button.bind_visibility_from(appObject, 'isFeedLoading')
+
+with ui.column().classes('self-center w-96'):
+    progress_bar = ui.linear_progress(show_value=False)
+    progress_bar.bind_value_from(appObject.precompute, 'progress')
+    progress_bar.bind_visibility_from(appObject, 'isFeedLoading')
+    progress_label = ui.label().classes('self-center')
+    progress_label.bind_text_from(appObject.precompute, 'stage')
 
 csv_uris = []
 lscsv = os.scandir('CSVs')
@@ -405,7 +477,8 @@ for e in lscsv:
     csv_uris.append(e.path)
 with ui.row().classes('self-center'):
     ui.label("Select CSV File: ").classes('self-center')
-    csv_selector = ui.select(csv_uris).classes('self-center w-96')
+    csv_selector = ui.select(csv_uris, on_change=start_precompute)
+    csv_selector.classes('self-center w-96')
     csv_selector.bind_value(appObject, 'csvURI')
     # csv_button = ui.button('Load CSV')
     # csv_button.classes('self-center')
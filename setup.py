@@ -21,7 +21,8 @@ setup(
         "geopandas",
         "shapely",
         "utm>=0.7.0",
-        "h3>3.7.7",
+        "pyproj",
+        "scipy",
         "haversine",
         # Plotting
         "branca>=0.6.0",
@@ -30,6 +31,10 @@ setup(
         "folium>=0.14.0",
         "unicode>=2.9",
     ],
+    extras_require={
+        # Partitioned ridership datasets (ridership_functions.ingest_ridership)
+        "parquet": ["pyarrow"],
+    },
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Intended Audience :: Developers",
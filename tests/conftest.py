@@ -0,0 +1,90 @@
+import os
+import sys
+import zipfile
+
+import pytest
+
+# The ridership scripts import each other (and gtfs_plots) as top-level modules
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "ridership_functions"))
+sys.path.append(os.path.join(ROOT, "gtfs_functions"))
+
+# One route, two trips each way. Trips T1 and T2 share a block with a
+# layover from 6:30 to 6:45 at the end of the line.
+TRIPS = [
+    ("T1", 0, "06:00:00", "06:30:00"),
+    ("T2", 1, "06:45:00", "07:15:00"),
+    ("T3", 0, "07:00:00", "07:30:00"),
+    ("T4", 1, "08:00:00", "08:30:00"),
+]
+BLOCKS = {"T1": "B1", "T2": "B1", "T3": "B2", "T4": "B3"}
+
+
+def _seconds(time):
+    h, m, s = map(int, time.split(":"))
+    return h * 3600 + m * 60 + s
+
+
+def _write_feed(path, blocks, n_stops, numeric_ids):
+    # Stops evenly spaced from A to B. The shapes bend between each pair of stops.
+    stop_ids = ["S_A"] + [f"S_{i}" for i in range(1, n_stops - 1)] + ["S_B"]
+    if numeric_ids:
+        # Like the StopIds of APC data
+        stop_ids = [str(1000 + i) for i in range(n_stops)]
+    stop_names = ["A"] + [f"Stop {i}" for i in range(1, n_stops - 1)] + ["B"]
+    stop_lons = [-111.90 + 0.10 * i / (n_stops - 1) for i in range(n_stops)]
+    vertices = [(40.70, stop_lons[0])]
+    for i in range(1, n_stops):
+        if n_stops > 2:
+            vertices.append((40.702, (stop_lons[i - 1] + stop_lons[i]) / 2))
+        vertices.append((40.70, stop_lons[i]))
+
+    trips_header = "route_id,service_id,trip_id,direction_id,shape_id" + (",block_id" if blocks else "")
+    trips = [
+        f"R1,WK,{trip_id},{direction},S{direction}" + (f",{BLOCKS[trip_id]}" if blocks else "")
+        for trip_id, direction, _, _ in TRIPS
+    ]
+    stop_times = []
+    for trip_id, direction, start, end in TRIPS:
+        stops = stop_ids if direction == 0 else stop_ids[::-1]
+        for i, stop_id in enumerate(stops):
+            t = _seconds(start) + (_seconds(end) - _seconds(start)) * i // (n_stops - 1)
+            t = f"{t // 3600:02d}:{t // 60 % 60:02d}:{t % 60:02d}"
+            stop_times.append(f"{trip_id},{t},{t},{stop_id},{i + 1}")
+    shapes = [f"S0,{lat:.3f},{lon:.4f},{i + 1}" for i, (lat, lon) in enumerate(vertices)] + [
+        f"S1,{lat:.3f},{lon:.4f},{i + 1}" for i, (lat, lon) in enumerate(vertices[::-1])
+    ]
+    stops_txt = [f"{stop_id},{name},40.70,{lon:.4f}" for stop_id, name, lon in zip(stop_ids, stop_names, stop_lons)]
+
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr(
+            "agency.txt", "agency_id,agency_name,agency_url,agency_timezone\nA,Agency,http://a,America/Denver\n"
+        )
+        z.writestr("routes.txt", "route_id,route_short_name,route_long_name,route_type\nR1,1,Line 1,3\n")
+        z.writestr(
+            "calendar.txt",
+            "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+            "WK,1,1,1,1,1,0,0,20240101,20241231\n",
+        )
+        z.writestr("trips.txt", "\n".join([trips_header] + trips) + "\n")
+        z.writestr("stops.txt", "\n".join(["stop_id,stop_name,stop_lat,stop_lon"] + stops_txt) + "\n")
+        z.writestr("shapes.txt", "\n".join(["shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence"] + shapes) + "\n")
+        z.writestr(
+            "stop_times.txt",
+            "\n".join(["trip_id,arrival_time,departure_time,stop_id,stop_sequence"] + stop_times) + "\n",
+        )
+    return str(path)
+
+
+@pytest.fixture
+def write_feed(tmp_path):
+    """
+    Writes the test feed to a zip in tmp_path, with or without block_id,
+    with n_stops stops along the line and optionally numeric stop_ids,
+    and returns its path.
+    """
+
+    def write(name="feed.zip", blocks=True, n_stops=2, numeric_ids=False):
+        return _write_feed(tmp_path / name, blocks, n_stops, numeric_ids)
+
+    return write
@@ -0,0 +1,30 @@
+import pandas as pd
+import pytest
+
+from gtfs_functions import Feed
+
+LEVELS = {
+    "stops": ("stops_freq", ["stop_id", "direction_id"]),
+    "lines": ("lines_freq", ["route_id", "direction_id"]),
+    "segments": ("segments_freq", ["route_id", "start_stop_id", "direction_id"]),
+}
+
+
+@pytest.mark.parametrize("level", LEVELS)
+def test_rolling_interval_matches_fixed_window(write_feed, level):
+    feed = Feed(write_feed(n_stops=4), service_ids=["WK"], time_windows=[6, 9])
+    product, keys = LEVELS[level]
+
+    fixed = getattr(feed, product)
+    fixed = fixed.loc[fixed.route_id != "ALL_LINES"] if "route_id" in fixed else fixed
+    rolling = feed.get_rolling_freq(level, window=180, step=60, start=6, end=9)
+
+    assert len(rolling) > 0
+    assert rolling.direction_id.dtype == feed.trips.direction_id.dtype
+    columns = keys + ["ntrips", "min_per_trip"]
+    pd.testing.assert_frame_equal(
+        rolling[columns].sort_values(keys).reset_index(drop=True),
+        fixed[columns].astype({"direction_id": int}).sort_values(keys).reset_index(drop=True),
+        check_dtype=False,
+    )
+    assert pd.api.types.is_integer_dtype(rolling.min_per_trip)
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+import ridership_functions as rfx
+
+from gtfs_functions import Feed
+
+APC = pd.DataFrame(
+    {
+        "LineAbbr": ["1", "1", "1", "1", "2"],
+        "Direction": [0, 0, 1, 0, 0],
+        "Service": ["Weekday", "Weekday", "Weekday", "Saturday", "Weekday"],
+        "StopId": [10, 11, 11, 10, 12],
+        "AverageOn": [5.0, 1.0, 4.0, 2.0, 3.0],
+        "AverageOff": [0.0, 6.0, 4.0, 2.0, 3.0],
+        "Sequence": [1, 2, 1, 1, 1],
+        "AverageLoad": [5.0, 0.0, 4.0, 2.0, 3.0],
+        "StopName": ["A", "B", "B", "A", "C"],
+    }
+)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    pytest.importorskip("pyarrow", exc_type=ImportError)
+    csv = tmp_path / "2024_January_Stops.csv"
+    APC.to_csv(csv, index=False)
+    rfx.ingest_ridership(str(csv), str(tmp_path / "rds"))
+    return str(csv), str(tmp_path / "rds")
+
+
+def test_dataset_reads_only_the_rows_of_the_route(dataset, monkeypatch):
+    csv, path = dataset
+    reads = []
+    read_ridership = rfx.read_ridership
+    monkeypatch.setattr(rfx, "read_ridership", lambda *a, **k: reads.append(a[1:4]) or read_ridership(*a, **k))
+
+    store = rfx.get_ridership_store(path)
+    aggregate = rfx.agg_rider_data(path, "1", 0, "Weekday")
+
+    assert isinstance(store, rfx.RidershipDataset)
+    assert reads == [("1", 0, "Weekday")]
+    pd.testing.assert_frame_equal(aggregate, rfx.agg_rider_data(csv, "1", 0, "Weekday"))
+
+
+def test_dataset_with_several_months_needs_a_month(dataset):
+    csv, path = dataset
+    rfx.ingest_ridership(csv, path, month="2024-02")
+
+    with pytest.raises(ValueError):
+        rfx.get_ridership_store(path)
+    assert rfx.get_ridership_store(path, month="2024-02").month == "2024-02"
+
+
+@pytest.fixture
+def network(write_feed, tmp_path):
+    """
+    A feed with numeric stop_ids and APC data for every stop of it, one of
+    them (StopId 9999) not in the feed.
+    """
+    feed = Feed(write_feed(n_stops=8, numeric_ids=True), service_ids=["WK"], time_windows=[0, 24])
+    stops = feed.stop_times.drop_duplicates(["direction_id", "stop_id"])
+    apc = pd.DataFrame(
+        {
+            "LineAbbr": "1",
+            "Direction": stops.direction_id.values,
+            "Service": "Weekday",
+            "StopId": stops.stop_id.astype(int).values,
+            "AverageOn": np.arange(len(stops)) % 5 + 1.0,
+            "AverageOff": np.arange(len(stops)) % 3 + 0.5,
+            "Sequence": stops.stop_sequence.values,
+            "AverageLoad": np.arange(len(stops)) % 7 + 2.0,
+            "StopName": stops.stop_name.values,
+        }
+    )
+    apc.loc[len(apc)] = ["1", 0, "Weekday", 9999, 1.0, 1.0, 99, 1.0, "Ghost"]
+    csv = tmp_path / "apc.csv"
+    apc.to_csv(csv, index=False)
+    return feed, str(csv)
+
+
+def test_network_productivity_matches_each_route(network):
+    feed, csv = network
+    net = rfx.get_network_productivity(feed, csv)
+
+    route_id = rfx.route_id_from_route_num(feed, "1")
+    for direction in [0, 1]:
+        segments = rfx.get_route_speed_segments(feed, route_id, direction)
+        riders = rfx.agg_rider_data(csv, "1", direction, "Weekday")
+        combined = rfx.combine_ridership_route(segments, riders, retry_matching=False)
+        combined = combined.drop(columns="_merge", errors="ignore")
+        expected = rfx.get_segment_productivity(combined, rfx.get_ntrips(feed, route_id, direction))
+
+        got = net.loc[("1", direction)]
+        # Seven segments and the end of the line
+        assert len(got) == 8
+        pd.testing.assert_frame_equal(
+            pd.DataFrame(got).assign(geometry=got.geometry.to_wkt()),
+            pd.DataFrame(expected).assign(geometry=expected.geometry.to_wkt()),
+            check_dtype=False,
+            check_index_type=False,
+        )
+
+
+def test_bin_stops_matches_a_geometric_dissolve(network):
+    feed, csv = network
+    route_id = rfx.route_id_from_route_num(feed, "1")
+    segments = rfx.get_route_speed_segments(feed, route_id, 0)
+    combined = rfx.combine_ridership_route(segments, rfx.agg_rider_data(csv, "1", 0, "Weekday"))
+
+    binned = rfx.bin_stops(combined, [0, 3, 5])
+
+    # What aggregate_stops did before joining the lines itself
+    groups = pd.cut(combined.index, bins=[0, 3, 5, len(combined) + 1], right=False, labels=False)
+    expected = combined.assign(groups=groups)
+    expected = expected.dissolve(
+        by="groups",
+        aggfunc={
+            "runtime_sec": "sum",
+            "start_stop_name": "first",
+            "end_stop_name": "last",
+            "end_stop_id": "last",
+            "distance_m": "sum",
+            "AverageOn": "sum",
+            "AverageOff": "sum",
+            "AverageLoad": "median",
+            "distance_mi": "sum",
+        },
+    )
+    expected["segment_name"] = expected["start_stop_name"] + "/" + expected["end_stop_name"]
+
+    assert len(binned) == 3
+    assert binned.geometry.geom_equals(expected.geometry).all()
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(binned.drop(columns="geometry")), pd.DataFrame(expected[binned.columns.drop("geometry")])
+    )
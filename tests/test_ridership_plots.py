@@ -0,0 +1,36 @@
+import pytest
+import ridership_plots as rplt
+
+from gtfs_functions import Feed
+
+
+@pytest.fixture
+def built(monkeypatch):
+    """
+    Records the (route, time_windows) of every layer LayerCache builds.
+    """
+    calls = []
+
+    def route_layer_data(feed, route, edges, direction, csv):
+        calls.append((route, tuple(feed.time_windows)))
+        return len(calls)
+
+    monkeypatch.setattr(rplt, "route_layer_data", route_layer_data)
+    monkeypatch.setattr(rplt, "color_layer", lambda data, colorscale, highlight: data)
+    monkeypatch.setattr(rplt, "geojson_layer", lambda data, name: data)
+    return calls
+
+
+def test_layer_cache_misses_after_time_windows_change(write_feed, built):
+    feed = Feed(write_feed(), service_ids=["WK"], time_windows=[0, 24])
+    cache = rplt.LayerCache()
+
+    first = cache.get_layer(feed, "1", [0, 1], 0, "apc.csv", "speed")
+    assert cache.get_layer(feed, "1", [0, 1], 0, "apc.csv", "speed") == first
+    assert len(built) == 1
+
+    feed.time_windows = [6, 9]
+    second = cache.get_layer(feed, "1", [0, 1], 0, "apc.csv", "speed")
+
+    assert second != first
+    assert built == [("1", (0, 24)), ("1", (6, 9))]
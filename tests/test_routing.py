@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from gtfs_functions import Feed
+
+
+@pytest.fixture
+def feed(write_feed):
+    return Feed(write_feed(), service_ids=["WK"], time_windows=[0, 24])
+
+
+def test_earliest_arrival_rides_the_first_catchable_trip(feed):
+    arrivals = feed.get_earliest_arrival("S_A", "06:50:00", radius=0)
+
+    arrival = arrivals.set_index("stop_id").arrival_time
+    # T1 left at 6:00, so the next trip from A is T3 arriving at 7:30
+    assert arrival["S_B"] == 7.5 * 3600
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 1000])
+def test_arrival_profile_does_not_depend_on_batch_size(feed, batch_size):
+    departure_times = np.arange(5 * 3600, 9 * 3600, 600)
+    expected = feed.get_arrival_profile(
+        "S_A", departure_times=departure_times, radius=0, batch_size=len(departure_times)
+    )
+    profile = feed.get_arrival_profile("S_A", departure_times=departure_times, radius=0, batch_size=batch_size)
+
+    pd.testing.assert_frame_equal(profile, expected)
+    assert set(profile.departure_time) == set(departure_times)
@@ -0,0 +1,95 @@
+import logging
+import zipfile
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.ops import substring
+
+from gtfs_functions import Feed
+from gtfs_functions.aux_functions import code
+
+
+@pytest.fixture
+def path(write_feed):
+    return write_feed(n_stops=12)
+
+
+def test_segments_do_not_depend_on_n_jobs(path):
+    serial = Feed(path, service_ids=["WK"]).get_segments(n_jobs=1)
+    parallel = Feed(path, service_ids=["WK"]).get_segments(n_jobs=2)
+
+    assert len(serial) == 2 * 11
+    pd.testing.assert_frame_equal(serial, parallel, check_exact=True)
+
+
+def test_segments_are_the_shape_between_their_stops(path):
+    feed = Feed(path, service_ids=["WK"])
+    segments = feed.get_segments(n_jobs=1)
+
+    # What the row-by-row version did: project the stops onto the shape, cut it
+    # between them and measure the cut in UTM
+    shapes = feed.shapes.set_index("shape_id").geometry
+    stops = feed.stops.set_index("stop_id").geometry
+    for segment in segments.itertuples():
+        shape = shapes[segment.shape_id]
+        start = shape.project(stops[segment.start_stop_id], normalized=True)
+        end = shape.project(stops[segment.end_stop_id], normalized=True)
+        assert segment.geometry.equals(substring(shape, start, end, normalized=True))
+
+    expected = segments.geometry.to_crs(feed.metric_crs).length
+    assert feed.metric_crs.to_epsg() == 32612
+    np.testing.assert_allclose(segments.distance_m, expected, rtol=1e-9)
+
+
+def _move_vertex(path, new_path, shape_id):
+    # Moves the second vertex of a shape, so only that shape changes
+    with zipfile.ZipFile(path) as old, zipfile.ZipFile(new_path, "w") as new:
+        for name in old.namelist():
+            text = old.read(name).decode()
+            if name == "shapes.txt":
+                lines = text.splitlines()
+                i = next(i for i, line in enumerate(lines) if line.startswith(f"{shape_id},") and line.endswith(",2"))
+                lat, lon = lines[i].split(",")[1:3]
+                lines[i] = f"{shape_id},{float(lat) + 0.001:.3f},{lon},2"
+                text = "\n".join(lines) + "\n"
+            new.writestr(name, text)
+    return str(new_path)
+
+
+def test_segments_from_a_snapshot_equal_a_fresh_run(path, tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    snapshot = Feed(path, service_ids=["WK"]).snapshot()
+    new_path = _move_vertex(path, tmp_path / "new.zip", "S1")
+
+    fresh = Feed(new_path, service_ids=["WK"]).get_segments(n_jobs=1)
+    updated = Feed(new_path, service_ids=["WK"]).get_segments(n_jobs=1, previous=snapshot)
+    assert "Cutting 1 of 2 shapes" in caplog.text
+
+    pd.testing.assert_frame_equal(updated, fresh, check_exact=True)
+    # Only S1 changed
+    changed = ~fresh.geometry.geom_equals_exact(snapshot["segments"].geometry, 0)
+    assert set(fresh.shape_id[changed]) == {"S1"}
+
+
+def test_projected_segments_are_the_segments_in_the_metric_crs(path):
+    feed = Feed(path, service_ids=["WK"])
+    projected = feed.projected_segments
+
+    expected = feed.segments.to_crs(feed.metric_crs)
+    assert projected.crs == feed.metric_crs
+    assert projected.geometry.geom_equals_exact(expected.geometry, 1e-6).all()
+    np.testing.assert_allclose(projected.length, feed.segments.distance_m, rtol=1e-12)
+
+
+def test_code_does_not_modify_its_input(path):
+    segments = Feed(path, service_ids=["WK"]).segments
+    segments = gpd.GeoDataFrame(segments.drop(columns="geometry"), geometry=list(segments.geometry))
+    segments.index = segments.index + 10
+    before = segments.copy()
+
+    with pytest.deprecated_call():
+        assert code(segments) == 32612
+    pd.testing.assert_frame_equal(segments, before)
+    assert segments.crs is None
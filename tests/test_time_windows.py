@@ -0,0 +1,20 @@
+import pandas as pd
+import pytest
+
+from gtfs_functions import Feed
+
+PRODUCTS = ["stops_freq", "lines_freq", "segments_freq", "avg_speeds"]
+
+
+@pytest.mark.parametrize("product", PRODUCTS)
+def test_changed_time_windows_match_a_fresh_feed(write_feed, product):
+    path = write_feed(n_stops=6)
+    feed = Feed(path, service_ids=["WK"], time_windows=[0, 24])
+    # Compute everything with the old windows first
+    for name in PRODUCTS:
+        getattr(feed, name)
+
+    feed.time_windows = [0, 6.5, 7.25, 24]
+    fresh = Feed(path, service_ids=["WK"], time_windows=[0, 6.5, 7.25, 24])
+
+    pd.testing.assert_frame_equal(getattr(feed, product), getattr(fresh, product))
@@ -0,0 +1,33 @@
+import pytest
+
+from gtfs_functions import Feed
+
+
+def vehicles_at(feed, minute):
+    vehicles = feed.get_vehicles_in_service()
+    return vehicles.loc[(vehicles.route_id == "R1") & (vehicles.minute == minute), "vehicles"].iloc[0]
+
+
+@pytest.mark.parametrize("patterns", [True, False])
+def test_blocks_keep_vehicles_in_service_during_layovers(write_feed, patterns):
+    feed = Feed(write_feed(), service_ids=["WK"], patterns=patterns)
+
+    assert "block_id" in feed.trips.columns
+    # 6:35, layover between T1 and T2 of block B1
+    assert vehicles_at(feed, 6 * 60 + 35) == 1
+    # 7:05, T2 and T3 running
+    assert vehicles_at(feed, 7 * 60 + 5) == 2
+
+
+def test_default_feed_matches_feed_without_patterns(write_feed):
+    path = write_feed()
+    default = Feed(path, service_ids=["WK"]).get_peak_vehicles()
+    no_patterns = Feed(path, service_ids=["WK"], patterns=False).get_peak_vehicles()
+
+    assert default.equals(no_patterns)
+
+
+def test_trips_without_blocks_leave_service_at_their_last_arrival(write_feed):
+    feed = Feed(write_feed(blocks=False), service_ids=["WK"])
+
+    assert vehicles_at(feed, 6 * 60 + 35) == 0
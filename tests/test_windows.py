@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from gtfs_functions.aux_functions import fix_departure_time, label_creation, window_codes
+
+TIMES = np.array([0, 5.99, 6, 9.49, 9.5, 15, 23.99, 24, 25.5, 27]) * 3600
+
+
+def old_window_labels(times, cutoffs):
+    # window_creation before the shared window index
+    if max(cutoffs) <= 24:
+        times = fix_departure_time(times.copy())
+    windows = pd.cut(pd.Series(times / 3600), bins=cutoffs, right=False, labels=label_creation(cutoffs))
+    return windows.astype(object).where(windows.notnull(), None).tolist()
+
+
+@pytest.mark.parametrize("cutoffs", [[0, 6, 9, 15, 19, 22, 24], [6, 9.5], [0, 24], [5, 26]])
+def test_window_codes_match_window_creation_labels(cutoffs):
+    codes = window_codes(TIMES, cutoffs)
+    labels = [label_creation(cutoffs)[c] if c >= 0 else None for c in codes]
+
+    assert labels == old_window_labels(TIMES, cutoffs)